@@ -0,0 +1,47 @@
+# Compare the box-filter blurPicture against the true Gaussian convolution
+# Run from the repository root:  python benchmarks/bench_blur.py
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import media
+import numpy as np
+
+SIZE = 1000
+SIGMAS = [4, 4.7, 5, 10, 20, 50, 100]
+
+#Half black, half white, so the blur has a hard edge to work on
+edge = media.makeEmptyPicture(SIZE, SIZE, media.white)
+media.addRectFilled(edge, SIZE // 2, 0, SIZE // 2, SIZE, media.black)
+
+#Random noise and a fine checkerboard: texture, which is where the
+#approximation is worst
+rng = np.random.default_rng(0)
+noise = media._pictureFromRGB(rng.integers(0, 256, (SIZE, SIZE, 3),
+    dtype=np.uint8))
+squares = (np.indices((SIZE, SIZE)).sum(axis=0) // 4) % 2 * 255
+checker = media._pictureFromRGB(np.repeat(squares[:, :, np.newaxis], 3,
+    axis=2).astype(np.uint8))
+
+PICTURES = [("edge", edge), ("noise", noise), ("checker", checker)]
+
+#Run func, returning its result and how long it took
+def timeIt(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+print("%-8s %5s %10s %10s %10s" % ("picture", "sigma", "box (s)",
+    "exact (s)", "max error"))
+for name, picture in PICTURES:
+    for sigma in SIGMAS:
+        box, boxTime = timeIt(lambda: media.blurPicture(picture, sigma))
+        exact, exactTime = timeIt(lambda: media.blurPicture(picture, sigma,
+            True))
+        boxPix = media._pictureRGB(box).astype(int)
+        exactPix = media._pictureRGB(exact).astype(int)
+        error = abs(boxPix - exactPix).max()
+        print("%-8s %5s %10.3f %10.3f %10d" % (name, sigma, boxTime,
+            exactTime, error))
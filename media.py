@@ -95,6 +95,16 @@ import threading
 import collections
 import time
 import traceback
+import functools
+import array
+import zlib
+import struct
+import mmap
+import shutil
+import weakref
+import re
+import concurrent.futures
+import multiprocessing
 
 try:
     import PyQt5.QtGui as QtGui
@@ -111,6 +121,12 @@ except ImportError:
     except ImportError:
         sys.exit('Could not import PyQt5 or PySide6, install one or the other.')
 
+#NumPy is optional; only the whole-picture filters need it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Create an PyQt application object.
 #If we're running in Canopy, there already is one
 root = QtWidgets.QApplication.instance()
@@ -836,6 +852,20 @@ class Picture:
         #Optimization
         self.line = None
         self.lineindex = -1
+        #Counts changes to the picture, so cached results know when
+        #they are out of date
+        self.modCount = 0
+        self.integral = None
+        self.integralModCount = -1
+        #Histograms kept up to date by setPixel (see trackHistograms)
+        self.histograms = None
+        self.histogramModCount = -1
+        #The open drawing context, if any (see drawing)
+        self.drawingContext = None
+        #Image pyramid, built as needed (see pyramid)
+        self.levels = None
+        self.levelPictures = None
+        self.levelsModCount = -1
         
         #Keep a copy around forever (bad to do generally, but important for this)
         keepAround.append(self)
@@ -866,6 +896,8 @@ class Picture:
             #self.image = PIL.Image.open(filename)
             #Load the QImage
             self.image = QtGui.QImage(self.workfile)
+            self.modCount += 1
+            self.lineindex = -1
             if self.image.isNull():
                 #Load failed
                 #raise IOError
@@ -882,6 +914,7 @@ class Picture:
     #Set all pixels to a color
     def setAllPixelsToAColor(self, col):
         self.image.fill(QtGui.QColor(*col.getRGB()))
+        self.modCount += 1
     
     #Get Pixels
     def getPixels(self):
@@ -947,10 +980,20 @@ class Picture:
             self.lineindex = y
         #pixline = self.image.scanLine(y)
         #pixarray = pixline.asarray(4*self.width)
+        #Take the old color out of the tracked histograms
+        tracked = self.histograms is not None and\
+            self.histogramModCount == self.modCount
+        if tracked:
+            self.countPixel(pixarray[4*x+2], pixarray[4*x+1], pixarray[4*x], -1)
         #Set the corresponding bytes
         pixarray[4*x] = col.getBlue() #Blue
         pixarray[4*x+1] = col.getGreen() #Green
         pixarray[4*x+2] = col.getRed() #Red
+        self.modCount += 1
+        #Put the new color in
+        if tracked:
+            self.countPixel(col.getRed(), col.getGreen(), col.getBlue(), 1)
+            self.histogramModCount = self.modCount
     
     #Print the picture in Canopy
     #TODO make Windows-friendly
@@ -1037,72 +1080,137 @@ class Picture:
     
     #Copy the picture other into this one at position (x,y) for upper left
     def copyInto(self, other, x, y, rotation = 0):
-        painter = QtGui.QPainter()
-        painter.begin(self.image)
-        if rotation != 0:
-            painter.translate(x, y)
-            painter.rotate(rotation)
-            painter.translate(-x, -y)
-        painter.drawImage(x, y, other.image)
-        painter.end()
+        with self.drawing() as d:
+            d.drawPicture(other, x, y, rotation)
     
     #Draw a line on the picture 
     def addLine(self, col, x1, y1, x2, y2):
-        painter = QtGui.QPainter()
-        painter.begin(self.image)
-        painter.setPen(QtGui.QColor(*col.getRGB()))
-        painter.drawLine(x1, y1, x2, y2)
-        painter.end()
+        with self.drawing() as d:
+            d.addLine(x1, y1, x2, y2, col)
     
     #Draw text on the picture
     def addText(self, col, x, y, string, font = None):
-        painter = QtGui.QPainter()
-        painter.begin(self.image)
-        if font is not None:
-            painter.setFont(font)
-        painter.setPen(QtGui.QColor(*col.getRGB()))
-        painter.drawText(x, y, string)
-        painter.end()
+        with self.drawing() as d:
+            d.addTextWithStyle(x, y, string, font, col)
     
     #Draw a rectangle on the picture
     def addRect(self, col, x, y, w, h, isFilled):
-        painter = QtGui.QPainter()
-        qcol = QtGui.QColor(*col.getRGB())
-        painter.begin(self.image)
-        painter.setPen(qcol)
-        if isFilled:
-            painter.fillRect(x, y, w, h, qcol)
-        else:
-            painter.drawRect(x, y, w, h)
-        painter.end()
+        with self.drawing() as d:
+            if isFilled:
+                d.addRectFilled(x, y, w, h, col)
+            else:
+                d.addRect(x, y, w, h, col)
     
     #Draw an oval on the picture
     def addOval(self, col, x, y, w, h, isFilled):
-        painter = QtGui.QPainter()
-        qcol = QtGui.QColor(*col.getRGB())
-        painter.begin(self.image)
-        painter.setPen(qcol)
-        if isFilled:
-            painter.setBrush(QtGui.QBrush(qcol))
-            #painter.fillRect(x, y, w, h, qcol)
-        #else:
-        painter.drawEllipse(x, y, w, h)
-        painter.end()
+        with self.drawing() as d:
+            if isFilled:
+                d.addOvalFilled(x, y, w, h, col)
+            else:
+                d.addOval(x, y, w, h, col)
     
     def addArc(self, col, x, y, w, h, start, angle, isFilled):
-        painter = QtGui.QPainter()
-        qcol = QtGui.QColor(*col.getRGB())
-        painter.begin(self.image)
-        painter.setPen(qcol)
-        if isFilled:
-            painter.setBrush(QtGui.QBrush(qcol))
-            #*16 because these functions use 16ths of degrees
-            painter.drawPie(x, y, w, h, start*16, angle*16)
+        with self.drawing() as d:
+            if isFilled:
+                d.addArcFilled(x, y, w, h, start, angle, col)
+            else:
+                d.addArc(x, y, w, h, start, angle, col)
+
+    #Get a drawing context that keeps one painter open on the picture, so
+    #drawing lots of shapes is fast. Use it in a with statement:
+    #    with picture.drawing() as d:
+    #        d.addLine(0, 0, 100, 100, red)
+    #While it's open, the usual drawing functions (addLine(picture, ...),
+    #turtles, ...) on this picture use the same painter.
+    def drawing(self):
+        if self.drawingContext is None:
+            self.drawingContext = PictureDrawing(self)
+        return self.drawingContext
+
+    #Get the summed-area table of the picture, as a NumPy array with shape
+    #(height+1, width+1, 3). Entry [y, x] holds the red, green and blue
+    #totals of every pixel above and to the left of (x, y), so any
+    #rectangle's total takes just four lookups.
+    #The table is kept until the picture changes; don't modify it.
+    def integralImage(self):
+        _requireNumpy("integralImage()")
+        if self.integral is None or self.integralModCount != self.modCount:
+            rgb = _pictureRGB(self)
+            table = np.zeros((rgb.shape[0] + 1, rgb.shape[1] + 1, 3),
+                dtype=np.int64)
+            np.cumsum(rgb, axis=0, dtype=np.int64, out=table[1:, 1:])
+            np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+            self.integral = table
+            self.integralModCount = self.modCount
+        return self.integral
+
+    #Keep red, green, blue and luminance histograms up to date as pixels
+    #are set with setPixel, so histogram() can answer without looking at
+    #the whole picture. Other changes (drawing, copyInto, ...) make the
+    #next histogram() recount everything. Pass False to stop tracking.
+    def trackHistograms(self, on = True):
+        if on:
+            self.refreshHistograms()
         else:
-            #*16 because these functions use 16ths of degrees
-            painter.drawArc(x, y, w, h, start*16, angle*16)
-        painter.end()
-    
+            self.histograms = None
+
+    #Get the QImage at one level of the picture's image pyramid: level 0
+    #is the picture itself, and each level after is half the width and
+    #height of the one before (area averaged). Levels are built the first
+    #time they're needed and kept until the picture changes.
+    def pyramidLevel(self, level):
+        if self.levels is None or self.levelsModCount != self.modCount:
+            self.levels = [self.image]
+            self.levelPictures = None
+            self.levelsModCount = self.modCount
+        while len(self.levels) <= level:
+            self.levels.append(_halveImage(self.levels[-1]))
+        return self.levels[level]
+
+    #Get the most reduced pyramid level that is still at least factor
+    #times the size of the picture, for scaling down by factor
+    def nearestLevel(self, factor):
+        level = 0
+        width = self.image.width()
+        height = self.image.height()
+        while factor <= 0.5 and width > 1 and height > 1:
+            factor *= 2
+            width = (width + 1) // 2
+            height = (height + 1) // 2
+            level += 1
+        return self.pyramidLevel(level)
+
+    #Get the whole image pyramid as a list of Pictures, from this picture
+    #down to one that is a single pixel wide or high
+    def pyramid(self):
+        if self.levelPictures is None or self.levelsModCount != self.modCount:
+            self.pyramidLevel(0)
+            pictures = [self]
+            image = self.image
+            level = 0
+            while image.width() > 1 and image.height() > 1:
+                level += 1
+                image = self.pyramidLevel(level)
+                pictures.append(Picture(image))
+            self.levelPictures = pictures
+        return list(self.levelPictures)
+
+    #Recount the tracked histograms from scratch
+    def refreshHistograms(self):
+        self.histograms = {}
+        for channel in HISTOGRAM_CHANNELS:
+            self.histograms[channel] = _histogramArray(self, channel).tolist()
+        self.histogramModCount = self.modCount
+
+    #Add (amount 1) or remove (amount -1) one pixel's color from the
+    #tracked histograms
+    def countPixel(self, r, g, b, amount):
+        hists = self.histograms
+        hists["red"][r] += amount
+        hists["green"][g] += amount
+        hists["blue"][b] += amount
+        hists["luminance"][_luminance(r, g, b)] += amount
+
     #Save the picture
     #If fname is None, overwrite the file
     def writeOrFail(self, fname = None, fmt = None):
@@ -1134,6 +1242,276 @@ class Picture:
             #raise IOError
             reportErrorToUser(IOError, "Saving image failed")
 
+#Drawing context for a picture, made by Picture.drawing()
+#Keeps one QPainter open for as long as the with block lasts, and keeps
+#the pens, brushes and fonts it has made, so each shape costs very little
+class PictureDrawing:
+    #Constructor
+    def __init__(self, picture):
+        self.picture = picture
+        #The QPainter, while a with block is open (see painter)
+        self.openPainter = None
+        #How many with blocks are using this context
+        self.depth = 0
+        #QPens and QBrushes made so far, by (red, green, blue)
+        self.pens = {}
+        self.brushes = {}
+        #What the painter is set to now, so we only change what we need
+        self.penKey = None
+        self.brushKey = None
+        self.font = None
+        self.defaultFont = None
+
+    #Start drawing (the first with block opens the painter)
+    def __enter__(self):
+        if self.depth == 0:
+            self.openPainter = QtGui.QPainter()
+            self.openPainter.begin(self.picture.image)
+            self.defaultFont = self.painter.font()
+            self.font = self.defaultFont
+            self.penKey = None
+            self.brushKey = None
+            self.picture.drawingContext = self
+        self.depth += 1
+        return self
+
+    #Stop drawing (the last with block closes the painter)
+    def __exit__(self, excType, excValue, tb):
+        self.depth -= 1
+        if self.depth == 0:
+            self.openPainter.end()
+            self.openPainter = None
+            self.picture.drawingContext = None
+            #Cached scan lines may point at an old buffer now
+            self.picture.lineindex = -1
+            self.picture.modCount += 1
+        return False
+
+    #The open QPainter; drawing outside a with block is an error
+    @property
+    def painter(self):
+        if self.openPainter is None:
+            repValError("Drawing contexts only work in a with block:\n"
+                "    with picture.drawing() as d:\n"
+                "        d.addLine(0, 0, 100, 100, red)")
+        return self.openPainter
+
+    #Set the pen to a color, reusing pens we've already made
+    def usePen(self, col):
+        if not isinstance(col, Color):
+            repTypeError("Drawing color is not a color")
+        key = (col.r, col.g, col.b)
+        if key != self.penKey:
+            pen = self.pens.get(key)
+            if pen is None:
+                pen = QtGui.QPen(QtGui.QColor(*key))
+                self.pens[key] = pen
+            self.painter.setPen(pen)
+            self.penKey = key
+        return key
+
+    #Set the brush to a color (or None for no fill), reusing brushes
+    def useBrush(self, key):
+        if key != self.brushKey:
+            if key is None:
+                self.painter.setBrush(QtCore.Qt.NoBrush)
+            else:
+                brush = self.brushes.get(key)
+                if brush is None:
+                    brush = QtGui.QBrush(QtGui.QColor(*key))
+                    self.brushes[key] = brush
+                self.painter.setBrush(brush)
+            self.brushKey = key
+
+    #Set the font (None for the default)
+    def useFont(self, font):
+        if font is None:
+            font = self.defaultFont
+        if font is not self.font:
+            self.painter.setFont(font)
+            self.font = font
+
+    #Note that the picture changed, for anything cached about it
+    def changed(self):
+        self.picture.modCount += 1
+
+    #Draw a line
+    def addLine(self, x1, y1, x2, y2, acolor = black):
+        self.usePen(acolor)
+        if isinstance(x1, int) and isinstance(y1, int) and\
+                isinstance(x2, int) and isinstance(y2, int):
+            self.painter.drawLine(x1, y1, x2, y2)
+        else:
+            self.painter.drawLine(QtCore.QLineF(x1, y1, x2, y2))
+        self.changed()
+
+    #Draw text
+    def addText(self, x, y, string, acolor = black):
+        self.addTextWithStyle(x, y, string, None, acolor)
+
+    #Draw text in a style made with makeStyle
+    def addTextWithStyle(self, x, y, string, style, acolor = black):
+        self.usePen(acolor)
+        self.useFont(style)
+        self.painter.drawText(x, y, string)
+        self.changed()
+
+    #Draw a rectangle outline
+    def addRect(self, x, y, w, h, acolor = black):
+        self.usePen(acolor)
+        self.useBrush(None)
+        self.painter.drawRect(x, y, w, h)
+        self.changed()
+
+    #Draw a filled rectangle
+    def addRectFilled(self, x, y, w, h, acolor = black):
+        key = self.usePen(acolor)
+        self.useBrush(key)
+        self.painter.fillRect(x, y, w, h, self.brushes[key])
+        self.changed()
+
+    #Draw an oval outline
+    def addOval(self, x, y, w, h, acolor = black):
+        self.usePen(acolor)
+        self.useBrush(None)
+        self.painter.drawEllipse(x, y, w, h)
+        self.changed()
+
+    #Draw a filled oval
+    def addOvalFilled(self, x, y, w, h, acolor = black):
+        self.useBrush(self.usePen(acolor))
+        self.painter.drawEllipse(x, y, w, h)
+        self.changed()
+
+    #Draw an arc outline (angles in degrees)
+    def addArc(self, x, y, w, h, start, angle, acolor = black):
+        self.usePen(acolor)
+        self.useBrush(None)
+        #*16 because these functions use 16ths of degrees
+        self.painter.drawArc(x, y, w, h, start*16, angle*16)
+        self.changed()
+
+    #Draw a filled arc (angles in degrees)
+    def addArcFilled(self, x, y, w, h, start, angle, acolor = black):
+        self.useBrush(self.usePen(acolor))
+        #*16 because these functions use 16ths of degrees
+        self.painter.drawPie(x, y, w, h, start*16, angle*16)
+        self.changed()
+
+    #Draw another picture with its upper left corner at (x, y), turned
+    #clockwise by rotation degrees around that corner
+    def drawPicture(self, other, x, y, rotation = 0):
+        if rotation != 0:
+            self.painter.save()
+            self.painter.translate(x, y)
+            self.painter.rotate(rotation)
+            self.painter.translate(-x, -y)
+        self.painter.drawImage(QtCore.QPointF(x, y), other.image)
+        if rotation != 0:
+            self.painter.restore()
+        self.changed()
+
+    #Stop drawing outlines (for filled shapes)
+    def noPen(self):
+        if self.penKey != "none":
+            self.painter.setPen(QtCore.Qt.NoPen)
+            self.penKey = "none"
+
+    #Draw lots of rectangles, one for each (xs[i], ys[i], ws[i], hs[i])
+    #colors is one color for all of them, or one color for each
+    def addRects(self, xs, ys, ws, hs, colors = black, filled = True):
+        xs, ys, ws, hs = _coordinateLists("addRects", xs, ys, ws, hs)
+        for col, items in _colorGroups("addRects", colors, len(xs)):
+            rects = [QtCore.QRectF(xs[i], ys[i], ws[i], hs[i])
+                for i in items]
+            if filled:
+                self.noPen()
+                self.useBrush((col.r, col.g, col.b))
+            else:
+                self.usePen(col)
+                self.useBrush(None)
+            self.painter.drawRects(rects)
+        self.changed()
+
+    #Draw lots of single-pixel points, one at each (xs[i], ys[i])
+    def addPoints(self, xs, ys, colors = black):
+        xs, ys = _coordinateLists("addPoints", xs, ys)
+        for col, items in _colorGroups("addPoints", colors, len(xs)):
+            self.usePen(col)
+            self.painter.drawPoints(QtGui.QPolygonF(
+                [QtCore.QPointF(xs[i], ys[i]) for i in items]))
+        self.changed()
+
+    #Draw lots of lines, from (x1s[i], y1s[i]) to (x2s[i], y2s[i])
+    def addLines(self, x1s, y1s, x2s, y2s, colors = black):
+        x1s, y1s, x2s, y2s = _coordinateLists("addLines", x1s, y1s, x2s, y2s)
+        for col, items in _colorGroups("addLines", colors, len(x1s)):
+            self.usePen(col)
+            self.painter.drawLines([QtCore.QLineF(x1s[i], y1s[i], x2s[i],
+                y2s[i]) for i in items])
+        self.changed()
+
+    #Draw connected lines through the points (xs[i], ys[i]) in order
+    def addPolyline(self, xs, ys, acolor = black):
+        xs, ys = _coordinateLists("addPolyline", xs, ys)
+        self.usePen(acolor)
+        self.painter.drawPolyline(QtGui.QPolygonF(
+            [QtCore.QPointF(x, y) for x, y in zip(xs, ys)]))
+        self.changed()
+
+    #Draw lots of round dots size pixels across, centered on (xs[i], ys[i])
+    def addDots(self, xs, ys, colors = black, size = 4):
+        xs, ys = _coordinateLists("addDots", xs, ys)
+        for col, items in _colorGroups("addDots", colors, len(xs)):
+            key = (col.r, col.g, col.b, size)
+            if key != self.penKey:
+                pen = self.pens.get(key)
+                if pen is None:
+                    pen = QtGui.QPen(QtGui.QColor(col.r, col.g, col.b))
+                    pen.setWidthF(size)
+                    pen.setCapStyle(QtCore.Qt.RoundCap)
+                    self.pens[key] = pen
+                self.painter.setPen(pen)
+                self.penKey = key
+            self.painter.drawPoints(QtGui.QPolygonF(
+                [QtCore.QPointF(xs[i], ys[i]) for i in items]))
+        self.changed()
+
+#Turn sequences (or NumPy arrays) of numbers into lists of the same length
+def _coordinateLists(funcName, *sequences):
+    lists = []
+    for seq in sequences:
+        if hasattr(seq, "tolist"):
+            seq = seq.tolist()
+        lists.append(list(seq))
+    for lst in lists:
+        if len(lst) != len(lists[0]):
+            repValError(funcName + ": all the coordinate lists must be "
+                "the same length")
+    return lists
+
+#Group the items of a bulk drawing call by color
+#colors is one Color, or one Color (or (red, green, blue)) per item
+#Returns a list of (Color, list of item indices)
+def _colorGroups(funcName, colors, count):
+    if isinstance(colors, Color):
+        return [(colors, range(count))]
+    if hasattr(colors, "tolist"):
+        colors = colors.tolist()
+    if len(colors) != count:
+        repValError(funcName + ": there must be one color per item")
+    groups = {}
+    for i, col in enumerate(colors):
+        if isinstance(col, Color):
+            key = (col.r, col.g, col.b)
+        else:
+            key = (int(col[0]), int(col[1]), int(col[2]))
+        if key in groups:
+            groups[key].append(i)
+        else:
+            groups[key] = [i]
+    return [(Color(*key), items) for key, items in groups.items()]
+
 ##
 ## Global picture functions
 ##
@@ -1735,6 +2113,92 @@ def addArcFilled(picture,x,y,w,h,start,angle,acolor=black):
         #raise ValueError
     picture.addArc(acolor,x,y,w,h,start,angle,True)
 
+## drawing lots of shapes at once ##
+def addRects(picture, xs, ys, ws, hs, colors=black, filled=True):
+    """
+        Takes a picture and lists (or NumPy arrays) of x positions, y
+        positions, widths and heights, and draws a rectangle for each
+        position in the list, all in one go. Much faster than calling
+        addRectFilled over and over.
+
+        Rectangles of the same color are drawn together, so if they
+        overlap, which color ends up on top isn't always the list order.
+
+        :param picture: the picture you want to draw on
+        :param xs: the x-coordinates of the upper left corners
+        :param ys: the y-coordinates of the upper left corners
+        :param ws: the widths
+        :param hs: the heights
+        :param colors: one color for every rectangle, or a list with a color
+                    (or (red, green, blue)) for each one (optional)
+        :param filled: False to draw only outlines (optional)
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("addRects(picture, xs, ys, ws, hs[, colors, filled]): "
+            "First input is not a picture")
+    with picture.drawing() as d:
+        d.addRects(xs, ys, ws, hs, colors, filled)
+
+def addPoints(picture, xs, ys, colors=black):
+    """
+        Takes a picture and lists (or NumPy arrays) of x and y positions,
+        and colors the pixel at each position, all in one go.
+
+        :param picture: the picture you want to draw on
+        :param xs: the x-coordinates of the points
+        :param ys: the y-coordinates of the points
+        :param colors: one color for every point, or a list with a color
+                    (or (red, green, blue)) for each one (optional)
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("addPoints(picture, xs, ys[, colors]): "
+            "First input is not a picture")
+    with picture.drawing() as d:
+        d.addPoints(xs, ys, colors)
+
+def addLines(picture, x1s, y1s, x2s, y2s, colors=black):
+    """
+        Takes a picture and lists (or NumPy arrays) of starting and ending
+        positions, and draws a line for each one, all in one go. Much
+        faster than calling addLine over and over.
+
+        Lines of the same color are drawn together, so if they cross,
+        which color ends up on top isn't always the list order.
+
+        :param picture: the picture you want to draw on
+        :param x1s: the x-coordinates where the lines start
+        :param y1s: the y-coordinates where the lines start
+        :param x2s: the x-coordinates where the lines end
+        :param y2s: the y-coordinates where the lines end
+        :param colors: one color for every line, or a list with a color
+                    (or (red, green, blue)) for each one (optional)
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("addLines(picture, x1s, y1s, x2s, y2s[, colors]): "
+            "First input is not a picture")
+    with picture.drawing() as d:
+        d.addLines(x1s, y1s, x2s, y2s, colors)
+
+def addPolyline(picture, xs, ys, acolor=black):
+    """
+        Takes a picture and lists (or NumPy arrays) of x and y positions,
+        and draws lines joining the points one after another, like
+        connect-the-dots.
+
+        :param picture: the picture you want to draw on
+        :param xs: the x-coordinates of the points
+        :param ys: the y-coordinates of the points
+        :param acolor: the color you want to draw in (optional)
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("addPolyline(picture, xs, ys[, color]): "
+            "First input is not a picture")
+    if not isinstance(acolor, Color):
+        repTypeError("addPolyline(picture, xs, ys[, color]): "
+            "Last input is not a color")
+    with picture.drawing() as d:
+        d.addPolyline(xs, ys, acolor)
+
 ## note the -1; in JES we think of pictures as starting at (1,1) but not
 ## in the Java.
 ##
@@ -2157,9 +2621,862 @@ def scalePicture(picture, factor, smooth = False):
         filt = QtCore.Qt.SmoothTransformation
     else:
         filt = QtCore.Qt.FastTransformation
-    return Picture(picture.image.scaledToHeight(int(getHeight(picture) *\
+    #Shrinking starts from the nearest pyramid level, which is quicker
+    #and avoids jaggies
+    if factor < 1:
+        image = picture.nearestLevel(factor)
+    else:
+        image = picture.image
+    return Picture(image.scaledToHeight(int(getHeight(picture) *\
         factor), filt))
 
+#Make a QImage half the width and height of image (rounded up), where
+#each pixel is the average of a 2x2 block
+def _halveImage(image):
+    if np is None:
+        #No NumPy; Qt's smooth scaling is the next best thing
+        return image.scaled((image.width() + 1) // 2,
+            (image.height() + 1) // 2, QtCore.Qt.IgnoreAspectRatio,
+            QtCore.Qt.SmoothTransformation)
+    if image.format() != QtGui.QImage.Format_RGB32 and\
+            image.format() != QtGui.QImage.Format_ARGB32:
+        image = image.convertToFormat(QtGui.QImage.Format_RGB32)
+    pixels = _imageView(image, False).astype(np.uint16)
+    #Repeat the last row/column of odd-sized images
+    pixels = np.pad(pixels, ((0, pixels.shape[0] % 2),
+        (0, pixels.shape[1] % 2), (0, 0)), mode='edge')
+    sums = pixels[0::2, 0::2] + pixels[1::2, 0::2] + pixels[0::2, 1::2] +\
+        pixels[1::2, 1::2]
+    half = QtGui.QImage(sums.shape[1], sums.shape[0], image.format())
+    _imageView(half)[:] = (sums + 2) >> 2
+    return half
+
+#Resampling methods that resizePicture knows about
+RESIZE_METHODS = ("nearest", "bilinear", "area", "lanczos3")
+
+#The Lanczos window with 3 lobes
+def _lanczos3(x):
+    x = np.abs(x)
+    return np.where(x < 3, np.sinc(x) * np.sinc(x / 3), 0)
+
+#Work out which source pixels (and how much of each) make up every output
+#pixel when resizing one axis from inSize to outSize pixels. Returns an
+#outSize x taps array of source indices and a matching array of weights
+#that add up to 1 for each output pixel.
+#Tables are kept, so resizing lots of pictures to the same size only
+#works them out once.
+@functools.lru_cache(maxsize=32)
+def _resampleWeights(inSize, outSize, method):
+    scale = inSize / outSize
+    out = np.arange(outSize)
+    if method == "nearest":
+        indices = np.minimum(((out + 0.5) * scale).astype(np.int64),
+            inSize - 1)[:, np.newaxis]
+        return indices, np.ones(indices.shape, dtype=np.float32)
+    if method == "area":
+        #How much of each source pixel falls inside the output pixel
+        taps = int(math.ceil(scale)) + 1
+        first = np.floor(out * scale).astype(np.int64)
+        indices = first[:, np.newaxis] + np.arange(taps)
+        left = np.maximum(indices, (out * scale)[:, np.newaxis])
+        right = np.minimum(indices + 1, ((out + 1) * scale)[:, np.newaxis])
+        weights = np.maximum(right - left, 0)
+    else:
+        #Filter centered on the output pixel's position in the source,
+        #stretched out when shrinking so it averages enough pixels
+        stretch = max(scale, 1.0)
+        if method == "bilinear":
+            support = stretch
+            kernel = lambda x: np.maximum(1 - np.abs(x), 0)
+        else:
+            support = 3 * stretch
+            kernel = _lanczos3
+        centers = (out + 0.5) * scale - 0.5
+        taps = int(math.ceil(2 * support)) + 1
+        first = np.floor(centers - support).astype(np.int64) + 1
+        indices = first[:, np.newaxis] + np.arange(taps)
+        weights = kernel((indices - centers[:, np.newaxis]) / stretch)
+    indices = np.clip(indices, 0, inSize - 1)
+    weights = weights / weights.sum(axis=1, keepdims=True)
+    return indices, weights.astype(np.float32)
+
+#Resample a height x width x 3 array along one axis
+def _resampleAxis(arr, outSize, method, axis):
+    indices, weights = _resampleWeights(arr.shape[axis], outSize, method)
+    shape = [1] * arr.ndim
+    shape[axis] = outSize
+    result = None
+    for tap in range(indices.shape[1]):
+        part = np.take(arr, indices[:, tap], axis=axis) *\
+            weights[:, tap].reshape(shape)
+        if result is None:
+            result = part
+        else:
+            result += part
+    return result
+
+def resizePicture(picture, width, height, method = "bilinear",
+        mode = "stretch"):
+    """
+        Takes a picture and a new width and height, and returns a resized
+        copy of the picture.
+
+        The method picks how new pixels are worked out:
+            "nearest"  - copy the closest pixel (fastest, blocky)
+            "bilinear" - blend the nearby pixels (good all-round choice)
+            "area"     - average every pixel that is covered (best for
+                         shrinking)
+            "lanczos3" - a sharp, high quality filter (slowest)
+
+        The mode picks what happens if the shape changes:
+            "stretch" - the result is exactly width x height
+            "fit"     - keep the shape; the result fits inside width x
+                        height, so one side may come out smaller
+            "fill"    - keep the shape; cover all of width x height and
+                        trim off whatever sticks out past the edges
+
+        The sums needed for each size are remembered, so resizing lots of
+        pictures to the same size (like making thumbnails) is extra fast.
+
+        Needs NumPy.
+
+        :param picture: the picture you want to resize
+        :param width: the new width
+        :param height: the new height
+        :param method: how to work out new pixels (optional, default
+                    "bilinear")
+        :param mode: "stretch", "fit" or "fill" (optional, default
+                    "stretch")
+        :return: a new, resized picture
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("resizePicture(picture, width, height[, method, mode]): "
+            "First parameter is not a picture")
+    if not isinstance(width, int) or not isinstance(height, int):
+        repTypeError("resizePicture(picture, width, height[, method, mode]): "
+            "width and height must be integers")
+    if width <= 0 or height <= 0:
+        repValError("resizePicture(picture, width, height[, method, mode]): "
+            "width and height must be positive")
+    if method not in RESIZE_METHODS:
+        repValError("resizePicture(picture, width, height[, method, mode]): "
+            "method must be one of " + ", ".join(RESIZE_METHODS))
+    if mode not in ("stretch", "fit", "fill"):
+        repValError("resizePicture(picture, width, height[, method, mode]): "
+            "mode must be stretch, fit or fill")
+    _requireNumpy("resizePicture(picture, width, height[, method, mode])")
+    oldWidth = getWidth(picture)
+    oldHeight = getHeight(picture)
+    newWidth = width
+    newHeight = height
+    if mode != "stretch":
+        if mode == "fit":
+            scale = min(width / oldWidth, height / oldHeight)
+        else:
+            scale = max(width / oldWidth, height / oldHeight)
+        newWidth = max(1, int(round(oldWidth * scale)))
+        newHeight = max(1, int(round(oldHeight * scale)))
+    rgb = _pictureRGB(picture)
+    if method == "nearest":
+        rows = _resampleWeights(oldHeight, newHeight, method)[0][:, 0]
+        cols = _resampleWeights(oldWidth, newWidth, method)[0][:, 0]
+        resized = rgb[rows][:, cols]
+    else:
+        resized = _resampleAxis(rgb.astype(np.float32), newHeight, method, 0)
+        resized = _resampleAxis(resized, newWidth, method, 1)
+    if mode == "fill":
+        top = (newHeight - height) // 2
+        left = (newWidth - width) // 2
+        resized = resized[top:top + height, left:left + width]
+    return _pictureFromRGB(resized)
+
+##
+## Affine transforms
+## A transform is a 2x3 matrix ((a, b, c), (d, e, f)) that sends the point
+## (x, y) of a picture to (a*x + b*y + c, d*x + e*y + f)
+##
+
+def rotationMatrix(degrees, centerX = 0, centerY = 0):
+    """
+        Makes a transform that turns a picture clockwise by the given number
+        of degrees around the point (centerX, centerY). Use it with
+        transformPicture.
+
+        :param degrees: how far to turn, clockwise, in degrees
+        :param centerX: the x-coordinate to turn around (optional)
+        :param centerY: the y-coordinate to turn around (optional)
+        :return: the transform
+    """
+    cos = math.cos(math.radians(degrees))
+    sin = math.sin(math.radians(degrees))
+    return ((cos, -sin, centerX - cos * centerX + sin * centerY),
+        (sin, cos, centerY - sin * centerX - cos * centerY))
+
+def shearMatrix(shearX, shearY = 0):
+    """
+        Makes a transform that slants a picture: each point moves right by
+        shearX times its y-coordinate, and down by shearY times its
+        x-coordinate. Use it with transformPicture.
+
+        :param shearX: how much to slant sideways
+        :param shearY: how much to slant up and down (optional)
+        :return: the transform
+    """
+    return ((1.0, shearX, 0.0), (shearY, 1.0, 0.0))
+
+def flipMatrix(picture, horizontal = True):
+    """
+        Makes a transform that mirrors a picture left-to-right (or, if
+        horizontal is False, top-to-bottom), keeping it in the same place.
+        Use it with transformPicture.
+
+        :param picture: the picture you will flip
+        :param horizontal: True to flip left-to-right, False to flip
+                    top-to-bottom (optional)
+        :return: the transform
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("flipMatrix(picture[, horizontal]): "
+            "First parameter is not a picture")
+    if horizontal:
+        return ((-1.0, 0.0, float(getWidth(picture))), (0.0, 1.0, 0.0))
+    return ((1.0, 0.0, 0.0), (0.0, -1.0, float(getHeight(picture))))
+
+def combineMatrices(first, second):
+    """
+        Makes one transform that does the first transform and then the
+        second.
+
+        :param first: the transform to do first
+        :param second: the transform to do after it
+        :return: the combined transform
+    """
+    (a, b, c), (d, e, f) = second
+    (g, h, i), (j, k, l) = first
+    return ((a * g + b * j, a * h + b * k, a * i + b * l + c),
+        (d * g + e * j, d * h + e * k, d * i + e * l + f))
+
+#Interpolation choices for transformPicture
+TRANSFORM_INTERPOLATIONS = ("nearest", "bilinear")
+
+#Work out, for every output pixel, which source pixels it comes from.
+#Returns flat source indices (one per neighbor used), the fractions of the
+#way from the top left neighbor across and down (None for "nearest"), and
+#a mask of output pixels that land inside the source.
+#The last couple of grids are kept, so applying the same transform to many
+#frames of the same size only works them out once; each one can take tens
+#of megabytes for a big picture, so no more are kept than that.
+@functools.lru_cache(maxsize=2)
+def _affineGrid(matrix, inWidth, inHeight, outWidth, outHeight,
+        interpolation):
+    (a, b, c), (d, e, f) = matrix
+    det = a * e - b * d
+    #Go backwards: from each output pixel's center to a source position
+    xs = np.arange(outWidth, dtype=np.float64) + 0.5 - c
+    ys = np.arange(outHeight, dtype=np.float64)[:, np.newaxis] + 0.5 - f
+    srcX = (e * xs - b * ys) / det - 0.5
+    srcY = (-d * xs + a * ys) / det - 0.5
+    inside = (srcX >= -0.5) & (srcX <= inWidth - 0.5) &\
+        (srcY >= -0.5) & (srcY <= inHeight - 0.5)
+    if interpolation == "nearest":
+        col = np.clip(np.rint(srcX), 0, inWidth - 1).astype(np.int32)
+        row = np.clip(np.rint(srcY), 0, inHeight - 1).astype(np.int32)
+        return [row * inWidth + col], None, inside
+    left = np.floor(srcX)
+    top = np.floor(srcY)
+    wx = (srcX - left).astype(np.float32)
+    wy = (srcY - top).astype(np.float32)
+    cols = [np.clip(left, 0, inWidth - 1).astype(np.int32),
+        np.clip(left + 1, 0, inWidth - 1).astype(np.int32)]
+    rows = [np.clip(top, 0, inHeight - 1).astype(np.int32),
+        np.clip(top + 1, 0, inHeight - 1).astype(np.int32)]
+    indices = [rows[0] * inWidth + cols[0], rows[0] * inWidth + cols[1],
+        rows[1] * inWidth + cols[0], rows[1] * inWidth + cols[1]]
+    return indices, (wx, wy), inside
+
+def transformPicture(picture, matrix, outputSize = None,
+        interpolation = "bilinear", background = black):
+    """
+        Takes a picture and a transform, and returns a new picture showing
+        the picture moved, turned, slanted, flipped or stretched by the
+        transform. Make transforms with rotationMatrix, shearMatrix,
+        flipMatrix and combineMatrices, or write your own 2x3 matrix
+        ((a, b, c), (d, e, f)), which sends the point (x, y) to
+        (a*x + b*y + c, d*x + e*y + f).
+
+        Parts of the result that don't come from the picture are filled
+        with the background color. Applying the same transform to many
+        pictures of the same size (like the frames of a movie) reuses the
+        work from the first one, so it is much faster.
+
+        Needs NumPy.
+
+        :param picture: the picture to transform
+        :param matrix: the transform
+        :param outputSize: (width, height) of the result (optional, default
+                    the same size as the picture)
+        :param interpolation: "nearest" or "bilinear" (optional, default
+                    "bilinear")
+        :param background: the color for uncovered parts (optional, default
+                    black)
+        :return: a new, transformed picture
+    """
+    funcName = "transformPicture(picture, matrix[, outputSize, " +\
+        "interpolation, background])"
+    if not isinstance(picture, Picture):
+        repTypeError(funcName + ": First parameter is not a picture")
+    try:
+        matrix = tuple(tuple(float(value) for value in row) for row in matrix)
+    except (TypeError, ValueError):
+        repTypeError(funcName + ": matrix must be 2 rows of 3 numbers")
+    if len(matrix) != 2 or len(matrix[0]) != 3 or len(matrix[1]) != 3:
+        repValError(funcName + ": matrix must be 2 rows of 3 numbers")
+    if matrix[0][0] * matrix[1][1] - matrix[0][1] * matrix[1][0] == 0:
+        repValError(funcName + ": matrix squashes the picture flat")
+    if outputSize is None:
+        outputSize = (getWidth(picture), getHeight(picture))
+    if len(outputSize) != 2 or outputSize[0] <= 0 or outputSize[1] <= 0:
+        repValError(funcName + ": outputSize must be (width, height)")
+    if interpolation not in TRANSFORM_INTERPOLATIONS:
+        repValError(funcName + ": interpolation must be nearest or bilinear")
+    if not isinstance(background, Color):
+        repTypeError(funcName + ": background is not a color")
+    _requireNumpy(funcName)
+    indices, fractions, inside = _affineGrid(matrix, getWidth(picture),
+        getHeight(picture), int(outputSize[0]), int(outputSize[1]),
+        interpolation)
+    source = _pictureRGB(picture).reshape(-1, 3)
+    if interpolation == "nearest":
+        result = source[indices[0]]
+    else:
+        wx, wy = fractions
+        weights = [(1 - wx) * (1 - wy), wx * (1 - wy), (1 - wx) * wy, wx * wy]
+        result = np.zeros(inside.shape + (3,), dtype=np.float32)
+        for index, weight in zip(indices, weights):
+            result += source[index] * weight[:, :, np.newaxis]
+    result[~inside] = background.getRGB()
+    return _pictureFromRGB(result)
+
+##
+## Whole-picture filters
+## These work on all of the pixels at once with NumPy, so they stay fast
+## even on very large pictures
+##
+
+#Complain if NumPy isn't installed
+def _requireNumpy(funcName):
+    if np is None:
+        reportErrorToUser(ImportError, funcName + ": this function needs "
+            "NumPy. Install it with: pip install numpy")
+
+#View a 32-bit QImage's pixels as a height x width x 4 NumPy array
+#The channels are in memory order (blue, green, red, unused), and
+#writing into the array writes straight into the image (unless writable
+#is False, which gives a read-only view without copying shared images)
+def _imageView(image, writable = True):
+    if writable:
+        ptr = image.bits()
+    else:
+        ptr = image.constBits()
+    if Qt_VERSION == 5:
+        ptr.setsize(image.sizeInBytes())
+    arr = np.frombuffer(ptr, dtype=np.uint8)
+    arr = arr.reshape(image.height(), image.bytesPerLine())
+    return arr[:, :4*image.width()].reshape(image.height(), image.width(), 4)
+
+#View the picture's pixels as a height x width x 4 NumPy array
+#(see _imageView); writing into the array writes into the picture
+def _pixelView(picture):
+    image = picture.image
+    if image.format() != QtGui.QImage.Format_RGB32 and\
+            image.format() != QtGui.QImage.Format_ARGB32:
+        image = image.convertToFormat(QtGui.QImage.Format_RGB32)
+        picture.image = image
+    #Cached scan lines may point at the old buffer after this
+    picture.lineindex = -1
+    return _imageView(image)
+
+#Get the picture's pixels as a height x width x 3 (red, green, blue) array
+def _pictureRGB(picture):
+    return _pixelView(picture)[:, :, 2::-1]
+
+#Make a new picture from a height x width x 3 (red, green, blue) array
+#Float values are rounded and clamped to 0-255
+def _pictureFromRGB(rgb):
+    if rgb.dtype != np.uint8:
+        rgb = np.clip(np.rint(rgb), 0, 255).astype(np.uint8)
+    picture = Picture(rgb.shape[1], rgb.shape[0])
+    view = _pixelView(picture)
+    view[:, :, 2::-1] = rgb
+    view[:, :, 3] = 255
+    return picture
+
+#Widths of the box filters whose repeated application approximates a
+#Gaussian with standard deviation sigma (Kovesi, "Fast almost-Gaussian
+#filtering"). All widths are odd so each box is centered.
+def _boxWidths(sigma, passes):
+    ideal = math.sqrt(12.0 * sigma * sigma / passes + 1)
+    lower = int(ideal)
+    if lower % 2 == 0:
+        lower -= 1
+    upper = lower + 2
+    numLower = round((12.0 * sigma * sigma - passes * lower * lower -\
+        4 * passes * lower - 3 * passes) / (-4 * lower - 4))
+    return [lower if i < numLower else upper for i in range(passes)]
+
+#Slice an array from start to stop along one axis (no copy)
+def _axisSlice(arr, start, stop, axis):
+    index = [slice(None)] * arr.ndim
+    index[axis] = slice(start, stop)
+    return arr[tuple(index)]
+
+#Box-blur a float array along one axis with a running sum
+#Costs the same no matter how wide the box is; edges are extended
+def _boxBlurAxis(arr, width, axis):
+    radius = width // 2
+    pad = [(0, 0)] * arr.ndim
+    pad[axis] = (radius + 1, radius)
+    padded = np.pad(arr, pad, mode='edge')
+    sums = np.cumsum(padded, axis=axis, dtype=np.float32)
+    n = arr.shape[axis]
+    upper = _axisSlice(sums, width, width + n, axis)
+    lower = _axisSlice(sums, 0, n, axis)
+    return (upper - lower) / width
+
+#Convolve a float array along one axis with a sampled Gaussian
+#Costs more the bigger sigma is; edges are extended
+def _gaussianBlurAxis(arr, sigma, axis):
+    radius = max(1, int(math.ceil(3 * sigma)))
+    weights = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+    weights /= weights.sum()
+    pad = [(0, 0)] * arr.ndim
+    pad[axis] = (radius, radius)
+    padded = np.pad(arr, pad, mode='edge')
+    n = arr.shape[axis]
+    out = np.zeros(arr.shape, dtype=np.float32)
+    for i in range(2 * radius + 1):
+        out += weights[i] * _axisSlice(padded, i, i + n, axis)
+    return out
+
+def blurPicture(picture, sigma, exact = False):
+    """
+        Takes a picture and a blur amount, and returns a new, blurred copy of
+        the picture. The blur is a Gaussian blur with standard deviation
+        sigma, in pixels; bigger numbers give a blurrier picture.
+
+        By default the Gaussian is approximated by three box blurs in a row,
+        each done with a running sum, so a blur with sigma 100 takes no
+        longer than one with sigma 4. Measured on hard black/white edges,
+        random noise and fine checkerboards with sigma from 4 to 100, each
+        color value differs from a true Gaussian blur by at most 4 (out of
+        255); on smooth pictures it's less. (Sigmas below 4 are too small to
+        approximate that well, so they always use the true Gaussian, which
+        is cheap at that size.) If exact is True, a true Gaussian kernel is
+        used instead, which gets slower as sigma grows.
+
+        Needs NumPy.
+
+        :param picture: the picture you want to blur
+        :param sigma: how much to blur, in pixels (a number above 0)
+        :param exact: use a true Gaussian instead of the fast one (optional)
+        :return: a new, blurred picture
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("blurPicture(picture, sigma): "
+            "First parameter is not a picture")
+    if not isinstance(sigma, numbers.Number):
+        repTypeError("blurPicture(picture, sigma): "
+            "Second parameter is not a number")
+    if sigma <= 0:
+        repValError("blurPicture(picture, sigma): "
+            "Second parameter must be positive")
+    _requireNumpy("blurPicture(picture, sigma)")
+    blurred = _pictureRGB(picture).astype(np.float32)
+    for axis in (0, 1):
+        if exact or sigma < 4:
+            blurred = _gaussianBlurAxis(blurred, sigma, axis)
+        else:
+            widths = _boxWidths(sigma, 3)
+            #Extend the edges once, by as far as all the boxes reach, and
+            #cut it off afterwards, so each box doesn't extend the last
+            #one's blurred edge again
+            reach = sum(width // 2 for width in widths) + 1
+            pad = [(0, 0)] * blurred.ndim
+            pad[axis] = (reach, reach)
+            blurred = np.pad(blurred, pad, mode='edge')
+            for width in widths:
+                if width > 1:
+                    blurred = _boxBlurAxis(blurred, width, axis)
+            blurred = _axisSlice(blurred, reach,
+                blurred.shape[axis] - reach, axis)
+    return _pictureFromRGB(blurred)
+
+#Check that a rectangle lies inside the picture
+def _checkRegion(funcName, picture, x, y, w, h):
+    if not isinstance(picture, Picture):
+        repTypeError(funcName + ": First parameter is not a picture")
+    for value in (x, y, w, h):
+        if not isinstance(value, numbers.Integral):
+            repTypeError(funcName + ": x, y, width and height must be "
+                "integers")
+    if w <= 0 or h <= 0:
+        repValError(funcName + ": width and height must be positive")
+    if x < 0 or y < 0 or x + w > getWidth(picture) or\
+            y + h > getHeight(picture):
+        repValError(funcName + ": the rectangle must be inside the picture")
+
+def regionSum(picture, x, y, w, h):
+    """
+        Takes a picture and a rectangle (upper left corner, width and
+        height), and returns the total of the red, green and blue values of
+        all the pixels in the rectangle. Uses the picture's integral image,
+        so it takes the same (tiny) time for any size of rectangle.
+
+        Needs NumPy.
+
+        :param picture: the picture to look at
+        :param x: the x-coordinate of the upper left corner of the rectangle
+        :param y: the y-coordinate of the upper left corner of the rectangle
+        :param w: the width of the rectangle
+        :param h: the height of the rectangle
+        :return: a tuple (red total, green total, blue total)
+    """
+    _checkRegion("regionSum(picture, x, y, w, h)", picture, x, y, w, h)
+    table = picture.integralImage()
+    total = table[y + h, x + w] - table[y, x + w] - table[y + h, x] +\
+        table[y, x]
+    return (int(total[0]), int(total[1]), int(total[2]))
+
+def regionMean(picture, x, y, w, h):
+    """
+        Takes a picture and a rectangle (upper left corner, width and
+        height), and returns the average color of the pixels in the
+        rectangle. Takes the same (tiny) time for any size of rectangle.
+
+        Needs NumPy.
+
+        :param picture: the picture to look at
+        :param x: the x-coordinate of the upper left corner of the rectangle
+        :param y: the y-coordinate of the upper left corner of the rectangle
+        :param w: the width of the rectangle
+        :param h: the height of the rectangle
+        :return: the average color of the rectangle
+    """
+    _checkRegion("regionMean(picture, x, y, w, h)", picture, x, y, w, h)
+    total = regionSum(picture, x, y, w, h)
+    area = w * h
+    return Color(round(total[0] / area), round(total[1] / area),
+        round(total[2] / area))
+
+def pixelate(picture, blockSize):
+    """
+        Takes a picture and a block size, and returns a new picture where
+        each blockSize x blockSize block of pixels is replaced by its
+        average color. Blocks at the right and bottom edges may be smaller.
+
+        Needs NumPy.
+
+        :param picture: the picture you want to pixelate
+        :param blockSize: the width and height of each block, in pixels
+        :return: a new, pixelated picture
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("pixelate(picture, blockSize): "
+            "First parameter is not a picture")
+    if not isinstance(blockSize, int):
+        repTypeError("pixelate(picture, blockSize): "
+            "Second parameter is not an integer")
+    if blockSize <= 0:
+        repValError("pixelate(picture, blockSize): "
+            "Second parameter must be positive")
+    table = picture.integralImage()
+    height = table.shape[0] - 1
+    width = table.shape[1] - 1
+    #Block edges, including the far edge of the picture
+    ys = np.append(np.arange(0, height, blockSize), height)
+    xs = np.append(np.arange(0, width, blockSize), width)
+    corners = table[np.ix_(ys, xs)]
+    sums = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] +\
+        corners[:-1, :-1]
+    heights = np.diff(ys)
+    widths = np.diff(xs)
+    means = sums / np.outer(heights, widths)[:, :, np.newaxis]
+    means = np.clip(np.rint(means), 0, 255).astype(np.uint8)
+    return _pictureFromRGB(np.repeat(np.repeat(means, heights, axis=0),
+        widths, axis=1))
+
+#Channels that histogram() knows about
+HISTOGRAM_CHANNELS = ("red", "green", "blue", "luminance")
+
+#Brightness of a color as seen by the eye, from 0 to 255
+#Works on single numbers and on NumPy arrays
+def _luminance(r, g, b):
+    return (77 * r + 150 * g + 29 * b + 128) >> 8
+
+#Check a histogram channel name
+def _checkChannel(funcName, channel):
+    if channel not in HISTOGRAM_CHANNELS:
+        repValError(funcName + ": channel must be one of " +
+            ", ".join(HISTOGRAM_CHANNELS))
+
+#Get one channel of the picture as a height x width array of 0-255 values
+def _channelArray(picture, channel):
+    rgb = _pictureRGB(picture)
+    if channel == "luminance":
+        wide = rgb.astype(np.uint32)
+        return _luminance(wide[:, :, 0], wide[:, :, 1],
+            wide[:, :, 2]).astype(np.uint8)
+    return rgb[:, :, HISTOGRAM_CHANNELS.index(channel)]
+
+#Count how many pixels have each value (0-255) in one channel
+def _histogramArray(picture, channel):
+    values = _channelArray(picture, channel)
+    return np.bincount(values.ravel(), minlength=256)
+
+def histogram(picture, channel = "luminance"):
+    """
+        Takes a picture and a channel name ("red", "green", "blue" or
+        "luminance"), and returns a list of 256 numbers: how many pixels
+        have each value from 0 to 255 in that channel. Luminance is the
+        brightness of each pixel as seen by the eye.
+
+        All the pixels are counted in one go, so this is fast even for big
+        pictures. If the picture is tracking its histograms (see
+        trackHistograms), the answer comes straight from the tracked
+        counts.
+
+        Needs NumPy.
+
+        :param picture: the picture to count
+        :param channel: which channel to count (optional, default luminance)
+        :return: a list of 256 counts
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("histogram(picture[, channel]): "
+            "First parameter is not a picture")
+    _checkChannel("histogram(picture[, channel])", channel)
+    _requireNumpy("histogram(picture[, channel])")
+    if picture.histograms is not None:
+        if picture.histogramModCount != picture.modCount:
+            picture.refreshHistograms()
+        return list(picture.histograms[channel])
+    return _histogramArray(picture, channel).tolist()
+
+def histogram2D(picture, channelX = "red", channelY = "green"):
+    """
+        Takes a picture and two channel names, and returns a 256 x 256 table
+        of counts: entry [x][y] is how many pixels have value x in channelX
+        and value y in channelY. Useful for seeing how two channels relate.
+
+        Needs NumPy.
+
+        :param picture: the picture to count
+        :param channelX: the first channel (optional, default red)
+        :param channelY: the second channel (optional, default green)
+        :return: a list of 256 lists of 256 counts
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("histogram2D(picture[, channelX, channelY]): "
+            "First parameter is not a picture")
+    _checkChannel("histogram2D(picture[, channelX, channelY])", channelX)
+    _checkChannel("histogram2D(picture[, channelX, channelY])", channelY)
+    _requireNumpy("histogram2D(picture[, channelX, channelY])")
+    xs = _channelArray(picture, channelX).astype(np.uint32)
+    ys = _channelArray(picture, channelY)
+    counts = np.bincount((xs * 256 + ys).ravel(), minlength=256 * 256)
+    return counts.reshape(256, 256).tolist()
+
+def trackHistograms(picture, on = True):
+    """
+        Makes the picture keep its histograms up to date as you change it
+        with setPixel (or setColor, setRed, ... on its pixels). After that,
+        histogram(picture, channel) is instant, which is handy for tools
+        that show a live histogram while you edit. Pass False to stop.
+
+        Needs NumPy.
+
+        :param picture: the picture to track
+        :param on: True to start tracking, False to stop (optional)
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("trackHistograms(picture[, on]): "
+            "First parameter is not a picture")
+    _requireNumpy("trackHistograms(picture[, on])")
+    picture.trackHistograms(on)
+
+#Make a new picture by looking up every red, green and blue value in a
+#table. luts is a 3 x 256 array (red, green, blue) of new values.
+def _applyLUTs(picture, luts):
+    luts = np.asarray(luts, dtype=np.uint8)
+    source = _pixelView(picture)
+    result = Picture(source.shape[1], source.shape[0])
+    target = _pixelView(result)
+    for channel in range(3):
+        #The view is in blue, green, red order
+        target[:, :, 2 - channel] = luts[channel][source[:, :, 2 - channel]]
+    target[:, :, 3] = 255
+    return result
+
+#Per-channel histograms of the picture, as a 3 x 256 array
+def _rgbHistograms(picture):
+    return np.array([_histogramArray(picture, channel)
+        for channel in ("red", "green", "blue")])
+
+def equalize(picture):
+    """
+        Takes a picture and returns a new picture with its histogram
+        equalized: each of red, green and blue is stretched so its values
+        are spread evenly from 0 to 255. This brings out detail in dull or
+        badly exposed pictures.
+
+        Needs NumPy.
+
+        :param picture: the picture to fix
+        :return: a new, equalized picture
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("equalize(picture): Input is not a picture")
+    _requireNumpy("equalize(picture)")
+    luts = []
+    for counts in _rgbHistograms(picture):
+        cdf = np.cumsum(counts)
+        lowest = cdf[counts.nonzero()[0][0]]
+        if cdf[-1] == lowest:
+            #Only one value, nothing to spread out
+            luts.append(np.arange(256))
+        else:
+            luts.append(np.rint((cdf - lowest) * 255.0 /
+                (cdf[-1] - lowest)).clip(0, 255))
+    return _applyLUTs(picture, luts)
+
+def autoLevels(picture, clip = 0.5):
+    """
+        Takes a picture and returns a new picture whose red, green and blue
+        are each stretched to use the full range from 0 to 255. The darkest
+        and lightest clip percent of each channel are ignored when finding
+        the range (and become 0 or 255), so a few stray pixels can't spoil
+        it.
+
+        Needs NumPy.
+
+        :param picture: the picture to fix
+        :param clip: the percent of pixels to ignore at each end (optional,
+                    default 0.5)
+        :return: a new picture with stretched levels
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("autoLevels(picture[, clip]): "
+            "First parameter is not a picture")
+    if not isinstance(clip, numbers.Number):
+        repTypeError("autoLevels(picture[, clip]): "
+            "Second parameter is not a number")
+    if clip < 0 or clip >= 50:
+        repValError("autoLevels(picture[, clip]): "
+            "clip must be at least 0 and less than 50")
+    _requireNumpy("autoLevels(picture[, clip])")
+    luts = []
+    values = np.arange(256)
+    for counts in _rgbHistograms(picture):
+        cdf = np.cumsum(counts)
+        cutoff = cdf[-1] * clip / 100.0
+        low = np.searchsorted(cdf, cutoff, side='right')
+        high = np.searchsorted(cdf, cdf[-1] - cutoff, side='left')
+        if high <= low:
+            luts.append(values)
+        else:
+            luts.append(np.rint((values - low) * 255.0 /
+                (high - low)).clip(0, 255))
+    return _applyLUTs(picture, luts)
+
+#Split the rows (or columns) of a picture into runs that lie between the
+#same two CLAHE tile centers. Returns a list of (start, stop, tile before,
+#tile after) and, for every row, how far it is toward the tile after.
+def _tileSpans(size, edges):
+    centers = (edges[:-1] + edges[1:] - 1) / 2.0
+    position = np.arange(size)
+    after = np.searchsorted(centers, position, side='right')
+    before = np.clip(after - 1, 0, len(centers) - 1)
+    after = np.clip(after, 0, len(centers) - 1)
+    span = centers[after] - centers[before]
+    span[span == 0] = 1
+    weight = np.clip((position - centers[before]) / span, 0, 1)
+    starts = np.flatnonzero(np.diff(before * len(centers) + after)) + 1
+    starts = [0] + starts.tolist()
+    stops = starts[1:] + [size]
+    spans = [(start, stop, before[start], after[start])
+        for start, stop in zip(starts, stops)]
+    return spans, weight.astype(np.float32)
+
+def clahe(picture, tiles = 8, clipLimit = 2.0):
+    """
+        Takes a picture and returns a new picture with contrast-limited
+        adaptive histogram equalization (CLAHE). The picture is cut into a
+        tiles x tiles grid, each tile is equalized on its own, and the
+        results are blended smoothly, so dark and light areas both get
+        their detail brought out. clipLimit keeps noise from being
+        boosted too much: bigger numbers give stronger contrast.
+
+        Needs NumPy.
+
+        :param picture: the picture to fix
+        :param tiles: how many tiles across and down (optional, default 8)
+        :param clipLimit: how much contrast to allow (optional, default 2)
+        :return: a new, equalized picture
+    """
+    if not isinstance(picture, Picture):
+        repTypeError("clahe(picture[, tiles, clipLimit]): "
+            "First parameter is not a picture")
+    if not isinstance(tiles, int):
+        repTypeError("clahe(picture[, tiles, clipLimit]): "
+            "tiles is not an integer")
+    if not isinstance(clipLimit, numbers.Number):
+        repTypeError("clahe(picture[, tiles, clipLimit]): "
+            "clipLimit is not a number")
+    if tiles <= 0 or clipLimit <= 0:
+        repValError("clahe(picture[, tiles, clipLimit]): "
+            "tiles and clipLimit must be positive")
+    _requireNumpy("clahe(picture[, tiles, clipLimit])")
+    source = _pixelView(picture)
+    height, width = source.shape[:2]
+    tilesDown = min(tiles, height)
+    tilesAcross = min(tiles, width)
+    yEdges = np.linspace(0, height, tilesDown + 1).astype(int)
+    xEdges = np.linspace(0, width, tilesAcross + 1).astype(int)
+    rowSpans, rowWeight = _tileSpans(height, yEdges)
+    colSpans, colWeight = _tileSpans(width, xEdges)
+    result = Picture(width, height)
+    target = _pixelView(result)
+    target[:, :, 3] = 255
+    for channel in range(3):
+        values = source[:, :, channel]
+        #Equalize each tile on its own, limiting the contrast
+        luts = np.empty((tilesDown, tilesAcross, 256), dtype=np.float32)
+        for ty in range(tilesDown):
+            for tx in range(tilesAcross):
+                tile = values[yEdges[ty]:yEdges[ty + 1],
+                    xEdges[tx]:xEdges[tx + 1]]
+                counts = np.bincount(tile.ravel(), minlength=256)
+                limit = max(clipLimit * tile.size / 256.0, 1)
+                excess = np.maximum(counts - limit, 0).sum()
+                counts = np.minimum(counts, limit) + excess / 256.0
+                luts[ty, tx] = (np.cumsum(counts) * 255.0 /
+                    tile.size).clip(0, 255)
+        #Blend the tables of the four nearest tiles, one block of pixels
+        #between tile centers at a time
+        for top, bottom, up, down in rowSpans:
+            wy = rowWeight[top:bottom, np.newaxis]
+            for left, right, before, after in colSpans:
+                block = values[top:bottom, left:right]
+                wx = colWeight[left:right]
+                above = (1 - wx) * luts[up, before][block] +\
+                    wx * luts[up, after][block]
+                below = (1 - wx) * luts[down, before][block] +\
+                    wx * luts[down, after][block]
+                blended = (1 - wy) * above + wy * below
+                target[top:bottom, left:right, channel] =\
+                    np.rint(blended).clip(0, 255)
+    return result
+
 ##
 # Input and Output interfaces
 #
@@ -2537,10 +3854,14 @@ class PictureExplorer(QtWidgets.QWidget):
         super().__init__()
         self.setWindowTitle("Image Explorer: " + pic.title)
         self.pic = duplicatePicture(pic)
+        #Zoomed views are made from this (and its pyramid)
+        self.sourcePic = self.pic
         self.fixedPixmap = QtGui.QPixmap.fromImage(pic.image)
         self.imageSize = self.fixedPixmap.size()
         # Keeptrack of zoom rate
         self.currentZoomRate = 1
+        #Zoomed images already made, by zoom rate
+        self.zoomImages = {}
 
         self.drawingPic = duplicatePicture(pic)
         self.layout = QtWidgets.QVBoxLayout()
@@ -2674,9 +3995,18 @@ class PictureExplorer(QtWidgets.QWidget):
     def updateZoom(self, zoomRate):
         self.drawingPic.width = int(self.imageSize.width()*zoomRate)
         self.drawingPic.height = int(self.imageSize.height()*zoomRate)
-        self.drawingPic.image = QtGui.QImage(self.fixedPixmap.scaled(
-            self.drawingPic.width, self.drawingPic.height,
-            QtCore.Qt.KeepAspectRatioByExpanding).toImage())
+        if zoomRate not in self.zoomImages:
+            #Zooming out starts from the nearest pyramid level
+            if zoomRate < 1:
+                source = self.sourcePic.nearestLevel(zoomRate)
+            else:
+                source = self.sourcePic.image
+            self.zoomImages[zoomRate] = source.scaled(
+                self.drawingPic.width, self.drawingPic.height,
+                QtCore.Qt.KeepAspectRatioByExpanding)
+        self.drawingPic.image = QtGui.QImage(self.zoomImages[zoomRate])
+        self.drawingPic.lineindex = -1
+        self.drawingPic.modCount += 1
         self.pic = self.drawingPic
         self.xwidget.setRange(0, self.drawingPic.getWidth()-1)
         self.ywidget.setRange(0, self.drawingPic.getHeight()-1)
@@ -2888,6 +4218,9 @@ def setWorldsEscapable(escapable):
     global WORLDS_ESCAPABLE
     WORLDS_ESCAPABLE = escapable
 
+#How far a drawn turtle can reach from its center, in pixels
+TURTLE_REACH = 16
+
 #Draw a turtle on a picture at given coordinates
 def drawTurtle(pic, x, y, heading, color):
     BODY_SIZE = 16
@@ -2915,27 +4248,208 @@ class World:
         self.turtles = list()
         #Picture being wrapped
         self.picture = makeEmptyPicture(self.width, self.height)
+        #Back buffer: the picture with the turtles drawn on top
         self.render = makeEmptyPicture(self.width, self.height)
         self.visible = False
+        #Rectangles (x, y, w, h) of the render that are out of date
+        self.dirty = []
+        #(x, y, heading, color) of each turtle as it was last drawn
+        self.drawn = {}
+        #The picture's modCount as of the last update, plus any changes
+        #turtles told us about; anything else means redrawing it all
+        self.pictureModCount = None
+        #Swarms of turtles living here, and whether any has changed since
+        #the last drawing
+        self.swarms = []
+        self.swarmsChanged = False
+        #Draw every tracer-th turtle step (0 means only when asked), and
+        #no more than fps times a second (None for no limit)
+        self.tracer = 1
+        self.fps = None
+        #Steps since the last drawing, and when that was
+        self.steps = 0
+        self.lastDrawn = 0.
+        #Whether a step hasn't been drawn yet, and whether a timer is set
+        #to draw it
+        self.pending = False
+        self.flushScheduled = False
+        #How many batch() blocks are open
+        self.batchDepth = 0
+        #Grid of cellSize square cells, each holding the turtles in it, so
+        #finding nearby turtles only looks at nearby cells
+        self.cellSize = 32
+        self.grid = {}
+        #Cell each turtle is in
+        self.cells = {}
+        #Movie being recorded into, if any (see record), how many drawings
+        #apart its frames are, how many drawings there have been, and the
+        #last frame (the next one is stored as the difference from it)
+        self.movie = None
+        self.every = 1
+        self.drawings = 0
+        self.lastFrame = None
         #Show the world
         self.update()
     
+    #Draw the world every n turtle steps instead of after each one (0 to
+    #draw only when update() is called), and, if fps is given, no more
+    #often than that many times a second. Drawing is what takes the time,
+    #so setTracer(0) then update() at the end draws complex pictures fast.
+    #With n above 1, or fps in a plain script, the last few steps may not
+    #be drawn until update() is called (or updateWorld), so call it when
+    #the turtles are done.
+    def setTracer(self, n = 1, fps = None):
+        self.tracer = n
+        self.fps = fps
+        self.steps = 0
+    
+    #Get a with block that holds off drawing the world until it ends:
+    #    with world.batch():
+    #        for i in range(1000):
+    #            forward(turtle, 1)
+    #            turn(turtle, 1)
+    def batch(self):
+        return WorldBatch(self)
+    
+    #A turtle moved, turned, drew, ...
+    #Draw it now, or later if tracing, batching or the frame rate says so
+    def step(self):
+        self.pending = True
+        if self.batchDepth > 0 or self.tracer == 0:
+            return
+        self.steps += 1
+        if self.steps < self.tracer:
+            return
+        if self.fps is not None and self.visible:
+            wait = self.lastDrawn + 1. / self.fps - time.time()
+            if wait > 0:
+                #Too soon; the next step after the time's up draws it.
+                #If an event loop is running, a timer draws it then too,
+                #in case no step comes; in a plain script, the last steps
+                #wait for update() (or updateWorld, or a batch ending)
+                if not self.flushScheduled and\
+                        QtCore.QThread.currentThread().loopLevel() > 0:
+                    self.flushScheduled = True
+                    QtCore.QTimer.singleShot(int(math.ceil(wait * 1000)),
+                        self.flush)
+                return
+        self.update()
+    
+    #Draw any steps that haven't been drawn yet
+    def flush(self):
+        self.flushScheduled = False
+        if self.pending and self.batchDepth == 0:
+            self.update()
+    
     #Update the view of the world
+    #Only the parts that changed since last time (pen lines, dropped
+    #pictures, turtles that moved) are copied from the picture and have
+    #their turtles redrawn
     def update(self):
         if self.visible:
             show_method = repaint
         else:
             show_method = lambda pic: show(pic, "World")
         
-        #Render the turtles on the picture
-        render = duplicatePicture(self.picture)
+        self.steps = 0
+        self.pending = False
+        #A flush still waiting will find nothing pending; let the next
+        #step too soon after this drawing wait for one of its own
+        self.flushScheduled = False
+        self.lastDrawn = time.time()
+        #Turtles that moved, turned, changed color or left need their
+        #old and new spots redrawn
+        drawn = {}
         for turtle in self.turtles:
-            drawTurtle(render, turtle.getXPos(), turtle.getYPos(),\
-                turtle.getHeading(), turtle.getColor())
-        copyInto(render, self.render, 0, 0)
+            state = (turtle.getXPos(), turtle.getYPos(), turtle.getHeading(),
+                turtle.getColor().getRGB())
+            drawn[turtle] = state
+            old = self.drawn.pop(turtle, None)
+            if old != state:
+                if old is not None:
+                    self.dirty.append(_turtleBounds(old[0], old[1]))
+                self.dirty.append(_turtleBounds(state[0], state[1]))
+        for old in self.drawn.values():
+            self.dirty.append(_turtleBounds(old[0], old[1]))
+        self.drawn = drawn
+        
+        full = not self.visible or self.swarmsChanged or\
+            self.pictureModCount != self.picture.modCount
+        if not full and not self.dirty:
+            #Nothing to redraw, just keep the window responsive
+            self.captureFrame()
+            QtWidgets.QApplication.processEvents()
+            return
+        
+        #Render the turtles on the picture
+        with self.render.drawing() as d:
+            if full:
+                d.drawPicture(self.picture, 0, 0)
+                for turtle in self.turtles:
+                    drawTurtle(self.render, turtle.getXPos(),\
+                        turtle.getYPos(), turtle.getHeading(),\
+                        turtle.getColor())
+                for swarm in self.swarms:
+                    swarm.drawSprites(d)
+            else:
+                bounds = QtCore.QRect(0, 0, self.width, self.height)
+                region = QtGui.QRegion()
+                for x, y, w, h in self.dirty:
+                    rect = QtCore.QRect(x, y, w, h).intersected(bounds)
+                    if rect.isEmpty():
+                        continue
+                    d.painter.drawImage(rect, self.picture.image, rect)
+                    region = region.united(rect)
+                #Redraw only the turtles that touch what we restored, and
+                #only inside it, so turtles on top stay on top
+                d.painter.setClipRegion(region)
+                for turtle in self.turtles:
+                    x, y, w, h = _turtleBounds(turtle.getXPos(),\
+                        turtle.getYPos())
+                    if region.intersects(QtCore.QRect(x, y, w, h)):
+                        drawTurtle(self.render, turtle.getXPos(),\
+                            turtle.getYPos(), turtle.getHeading(),\
+                            turtle.getColor())
+                for swarm in self.swarms:
+                    swarm.drawSprites(d)
+                d.painter.setClipping(False)
+                d.changed()
+        self.dirty = []
+        self.pictureModCount = self.picture.modCount
+        self.swarmsChanged = False
         self.visible = True
+        self.captureFrame()
         show_method(self.render)
     
+    #Add the world as drawn to the movie being recorded, if it's time to
+    def captureFrame(self):
+        if self.movie is None:
+            return
+        if self.drawings % self.every == 0:
+            self.lastFrame = DeltaFrame(self.render.image, self.lastFrame)
+            self.movie.addFrame(self.lastFrame)
+        self.drawings += 1
+    
+    #Add what the world looks like to the movie every time it's drawn
+    #(or every every-th time), until record(None) is called. Frames are
+    #kept in memory, as the compressed difference from the frame before.
+    def record(self, movie, every = 1):
+        self.movie = movie
+        self.every = every
+        self.drawings = 0
+        self.lastFrame = None
+        if movie is not None:
+            #Start with how it looks now
+            self.update()
+    
+    #A turtle drew on the picture inside (x, y, w, h); before is the
+    #picture's modCount from just before it drew. If nothing else has
+    #changed the picture, the next update only redraws that rectangle.
+    def pictureChanged(self, before, x, y, w, h):
+        self.dirty.append((x, y, w, h))
+        if before == self.pictureModCount:
+            self.pictureModCount = self.picture.modCount
+    
     #Show the world
     #(perhaps you closed it?)
     def show(self):
@@ -2946,7 +4460,107 @@ class World:
     #Should only be called by a turtle
     def addTurtle(self, turtle):
         self.turtles.append(turtle)
-        self.update()
+        self.turtleMoved(turtle)
+        self.step()
+    
+    #Which grid cell (x, y) is in
+    def cellAt(self, x, y):
+        return (int(math.floor(x / self.cellSize)),
+            int(math.floor(y / self.cellSize)))
+    
+    #Keep a turtle's place in the grid up to date
+    #Should only be called by a turtle (or addTurtle)
+    def turtleMoved(self, turtle):
+        cell = self.cellAt(turtle.getXPos(), turtle.getYPos())
+        old = self.cells.get(turtle)
+        if cell == old:
+            return
+        if old is not None:
+            del self.grid[old][turtle]
+            if not self.grid[old]:
+                del self.grid[old]
+        #Dicts rather than sets, so results come out in a fixed order
+        self.grid.setdefault(cell, {})[turtle] = None
+        self.cells[turtle] = cell
+    
+    #Get the turtles within radius of (x, y), nearest first
+    def turtlesNear(self, x, y, radius):
+        left, top = self.cellAt(x - radius, y - radius)
+        right, bottom = self.cellAt(x + radius, y + radius)
+        if (right - left + 1) * (bottom - top + 1) > len(self.grid):
+            #Fewer cells have turtles in them than the square covers, so
+            #just look at those
+            cells = [cell for cell in sorted(self.grid, key=lambda c:\
+                (c[1], c[0])) if left <= cell[0] <= right and\
+                top <= cell[1] <= bottom]
+        else:
+            cells = [(cellX, cellY) for cellY in range(top, bottom + 1)
+                for cellX in range(left, right + 1)]
+        found = []
+        for cell in cells:
+            for turtle in self.grid.get(cell, ()):
+                dist = math.hypot(turtle.getXPos() - x,\
+                    turtle.getYPos() - y)
+                if dist <= radius:
+                    found.append((dist, len(found), turtle))
+        found.sort()
+        return [turtle for dist, index, turtle in found]
+    
+    #Get the turtle nearest to the given one (None if it's alone)
+    def nearestTurtle(self, turtle):
+        x = turtle.getXPos()
+        y = turtle.getYPos()
+        cellX, cellY = self.cellAt(x, y)
+        best = None
+        bestDist = None
+        #How many other turtles there are left to look at
+        left = len(self.cells) - (1 if turtle in self.cells else 0)
+        ring = 0
+        #Look at rings of cells further and further out; turtles outside
+        #ring r are at least r cells away
+        while left > 0:
+            if 8 * ring > len(self.grid):
+                #The ring has more cells than there are cells with turtles
+                #in them (the rest are far away), so just look at those
+                for other in self.cells:
+                    if other is turtle:
+                        continue
+                    dist = math.hypot(other.getXPos() - x,\
+                        other.getYPos() - y)
+                    if best is None or dist < bestDist:
+                        best = other
+                        bestDist = dist
+                break
+            for dy in range(-ring, ring + 1):
+                if abs(dy) == ring:
+                    dxs = range(-ring, ring + 1)
+                else:
+                    dxs = (-ring, ring)
+                for dx in dxs:
+                    for other in self.grid.get((cellX + dx, cellY + dy), ()):
+                        if other is turtle:
+                            continue
+                        left -= 1
+                        dist = math.hypot(other.getXPos() - x,\
+                            other.getYPos() - y)
+                        if best is None or dist < bestDist:
+                            best = other
+                            bestDist = dist
+            if best is not None and bestDist <= ring * self.cellSize:
+                break
+            ring += 1
+        return best
+    
+    #Add a swarm
+    #Should only be called by a swarm
+    def addSwarm(self, swarm):
+        self.swarms.append(swarm)
+        self.swarmChanged()
+    
+    #A swarm moved, turned or changed color; swarms are redrawn whole
+    def swarmChanged(self):
+        self.swarmsChanged = True
+        self.step()
     
     #Retrieve the list of turtles
     def getTurtleList(self):
@@ -2957,6 +4571,31 @@ class World:
         return "A %d by %d world with %d turtles in it."%(self.width,\
             self.height, len(self.turtles))
 
+#Batch of turtle steps, made by World.batch()
+#The world is drawn once, when the outermost with block ends
+class WorldBatch:
+    #Constructor
+    def __init__(self, world):
+        self.world = world
+
+    #Stop drawing the world
+    def __enter__(self):
+        self.world.batchDepth += 1
+        return self.world
+
+    #Draw everything that happened in the block
+    def __exit__(self, excType, excValue, tb):
+        self.world.batchDepth -= 1
+        if self.world.batchDepth == 0:
+            self.world.flush()
+        return False
+
+#Rectangle (x, y, w, h) that holds a turtle drawn at (x, y)
+def _turtleBounds(x, y):
+    return (int(math.floor(x)) - TURTLE_REACH - 1,
+        int(math.floor(y)) - TURTLE_REACH - 1,
+        2 * TURTLE_REACH + 3, 2 * TURTLE_REACH + 3)
+
 #Turtles!
 class Turtle:
     #Constructor
@@ -2980,6 +4619,8 @@ class Turtle:
         self.color = green
         #Pen starts down
         self.hasPenDown = True
+        #Log of moves and drops, if recording (see startRecording)
+        self.recording = None
         if isinstance(self.world, World):
             #Add the turtle to the world
             world.addTurtle(self)
@@ -2990,7 +4631,12 @@ class Turtle:
     #Update visuals
     def update(self):
         if isinstance(self.world, World):
-            self.world.update()
+            self.world.step()
+    
+    #Tell the World we drew on its picture inside (x, y, w, h)
+    def drewOn(self, before, x, y, w, h):
+        if isinstance(self.world, World):
+            self.world.pictureChanged(before, x, y, w, h)
     
     #Nice string representation
     def __str__(self):
@@ -3074,12 +4720,23 @@ class Turtle:
             new_y = max(0, new_y)
             new_x = min(self.world.width, new_x)
             new_y = min(self.world.height, new_y)
+        if self.recording is not None:
+            self.recording.addMove(self.x, self.y, new_x, new_y,
+                self.hasPenDown, self.color)
         #Draw a line, if the pen is down
         if self.hasPenDown:
+            before = self.picture.modCount
             addLine(self.picture, self.x, self.y, new_x, new_y, self.color)
+            left = int(math.floor(min(self.x, new_x)))
+            top = int(math.floor(min(self.y, new_y)))
+            self.drewOn(before, left - 1, top - 1,
+                int(math.ceil(max(self.x, new_x))) - left + 3,
+                int(math.ceil(max(self.y, new_y))) - top + 3)
         #Move the turtle
         self.x = new_x
         self.y = new_y
+        if isinstance(self.world, World):
+            self.world.turtleMoved(self)
         #Update the World
         self.update()
     
@@ -3112,9 +4769,287 @@ class Turtle:
     
     #Drop a picture
     def drop(self, picture):
+        if self.recording is not None:
+            self.recording.addDrop(picture, self.x, self.y, self.heading)
+        before = self.picture.modCount
         self.picture.copyInto(picture, self.x, self.y, self.heading)
+        #It's turned around (x, y), so it fits in a circle this big
+        reach = int(math.ceil(math.hypot(picture.getWidth(),
+            picture.getHeight()))) + 1
+        self.drewOn(before, int(math.floor(self.x)) - reach,
+            int(math.floor(self.y)) - reach, 2 * reach + 1, 2 * reach + 1)
+        self.update()
+
+    #Start logging this turtle's moves and drops, so the drawing can be
+    #replayed later at any size. Pass a recording to add to it (to record
+    #several turtles together); returns the recording.
+    def startRecording(self, recording = None):
+        if recording is None:
+            recording = TurtleRecording(self.picture.getWidth(),\
+                self.picture.getHeight())
+        self.recording = recording
+        return recording
+    
+    #Stop logging, and return the recording
+    def stopRecording(self):
+        recording = self.recording
+        self.recording = None
+        return recording
+
+#Log of what turtles did, made by Turtle.startRecording()
+#Every move is kept in flat arrays: coords holds x1, y1, x2, y2 for each,
+#pens whether the pen was down, and colors an index into palette. drops
+#holds (number of moves before it, image, x, y, heading) for each drop.
+#Coordinates are in the original picture's pixels (width by height).
+class TurtleRecording:
+    #Constructor
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.coords = array.array("d")
+        self.pens = array.array("B")
+        self.colors = array.array("I")
+        self.palette = []
+        self.paletteIndex = {}
+        self.drops = []
+
+    #Number of moves recorded
+    def __len__(self):
+        return len(self.pens)
+
+    def __str__(self):
+        return "Turtle recording, %d moves and %d drops on %d by %d" %\
+            (len(self), len(self.drops), self.width, self.height)
+
+    #Log a move from (x1, y1) to (x2, y2)
+    def addMove(self, x1, y1, x2, y2, penDown, col):
+        key = col.getRGB()
+        index = self.paletteIndex.get(key)
+        if index is None:
+            index = len(self.palette)
+            self.palette.append(Color(*key))
+            self.paletteIndex[key] = index
+        self.coords.extend((x1, y1, x2, y2))
+        self.pens.append(1 if penDown else 0)
+        self.colors.append(index)
+
+    #Log a picture dropped at (x, y), turned by heading
+    def addDrop(self, picture, x, y, heading):
+        #QImages share their data until one changes, so this is cheap;
+        #setPixel's cached scan line would change it without Qt knowing,
+        #so forget it
+        picture.lineindex = -1
+        self.drops.append((len(self), QtGui.QImage(picture.image), x, y,
+            heading))
+
+    #Draw moves start to stop (and the drops between them) on picture,
+    #scaled to fit it. Drops made before any moves count as part of the
+    #first call (start 0).
+    def replay(self, picture, start = 0, stop = None):
+        if stop is None:
+            stop = len(self)
+        with picture.drawing() as d:
+            d.painter.save()
+            d.painter.scale(picture.getWidth() / self.width,\
+                picture.getHeight() / self.height)
+            pos = start
+            for index, image, x, y, heading in self.drops:
+                if index < start or (index == start and start > 0):
+                    continue
+                if index > stop:
+                    break
+                self.replayMoves(d, pos, index)
+                pos = index
+                d.painter.save()
+                d.painter.translate(x, y)
+                d.painter.rotate(heading)
+                d.painter.drawImage(QtCore.QPointF(0, 0), image)
+                d.painter.restore()
+            self.replayMoves(d, pos, stop)
+            d.painter.restore()
+            d.changed()
+
+    #Draw the pen-down moves start to stop, a run of one color at a time
+    def replayMoves(self, d, start, stop):
+        coords = self.coords
+        i = start
+        while i < stop:
+            index = self.colors[i]
+            lines = []
+            while i < stop and self.colors[i] == index:
+                if self.pens[i]:
+                    lines.append(QtCore.QLineF(coords[4*i], coords[4*i+1],
+                        coords[4*i+2], coords[4*i+3]))
+                i += 1
+            if lines:
+                d.usePen(self.palette[index])
+                d.painter.drawLines(lines)
+
+    #Replay onto a new width by height picture, a few moves at a time,
+    #giving a copy of the picture after every movesPerFrame moves.
+    #Handy for making a movie of the drawing.
+    def frames(self, width, height, movesPerFrame = 1, background = white):
+        picture = makeEmptyPicture(width, height, background)
+        start = 0
+        while True:
+            stop = min(start + movesPerFrame, len(self))
+            self.replay(picture, start, stop)
+            yield duplicatePicture(picture)
+            if stop >= len(self):
+                break
+            start = stop
+
+#Lots of turtles moving together, for simulations with thousands of them
+#Positions, headings, colors and pens are kept in NumPy arrays, so each
+#method acts on every turtle at once. Methods take either one value for
+#all the turtles or an array with one value each. Trails are drawn in one
+#batch per color, and the world draws all the turtles as dots in one go.
+class TurtleSwarm:
+    #Constructor
+    #Requires a world (or picture) and how many turtles
+    def __init__(self, world, count, x = None, y = None, heading = 0,\
+            color = green, size = 6):
+        _requireNumpy("TurtleSwarm()")
+        self.world = world
+        self.count = count
+        if isinstance(world, World):
+            self.picture = world.picture
+        else:
+            self.picture = world
+        #Start in the middle, like a Turtle
+        if x is None:
+            x = self.picture.getWidth() / 2
+            y = self.picture.getHeight() / 2
+        self.xs = self.perTurtle(x, "x")
+        self.ys = self.perTurtle(y, "y")
+        self.headings = self.perTurtle(heading, "heading") % 360
+        self.colors = np.zeros((count, 3), dtype=np.uint8)
+        self.pens = np.ones(count, dtype=bool)
+        #Diameter of each turtle's dot
+        self.size = size
+        if isinstance(color, Color):
+            color = color.getRGB()
+        self.colors[:] = np.clip(np.asarray(color), 0, 255)
+        if isinstance(world, World):
+            world.addSwarm(self)
+
+    def __len__(self):
+        return self.count
+
+    def __str__(self):
+        return "Swarm of %d turtles." % self.count
+
+    #Turn one value, or one per turtle, into a float array of them all
+    def perTurtle(self, value, what):
+        arr = np.array(value, dtype=np.float64)
+        if arr.ndim == 0:
+            return np.full(self.count, float(arr))
+        if arr.shape != (self.count,):
+            repValError("TurtleSwarm: there must be one %s per turtle" % what)
+        return arr.copy()
+
+    #Which turtles a which argument means (None for all of them)
+    def selected(self, which):
+        if which is None:
+            return slice(None)
+        return np.asarray(which)
+
+    #Update visuals
+    def update(self):
+        if isinstance(self.world, World):
+            self.world.swarmChanged()
+
+    #Accessors (arrays with one value per turtle; don't modify them)
+    def getXPos(self):
+        return self.xs
+
+    def getYPos(self):
+        return self.ys
+
+    def getHeading(self):
+        return self.headings
+
+    #Groups of turtles with the same color
+    #Returns a list of (Color, array of turtle indices); only the turtles
+    #in mask count, if it's given
+    def colorGroups(self, mask = None):
+        indices = np.arange(self.count)
+        packed = self.colors.astype(np.int64)
+        packed = (packed[:, 0] << 16) | (packed[:, 1] << 8) | packed[:, 2]
+        if mask is not None:
+            indices = indices[mask]
+            packed = packed[mask]
+        keys, inverse = np.unique(packed, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        splits = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+        return [(Color(int(key) >> 16, (int(key) >> 8) & 255, int(key) & 255),
+            indices[group]) for key, group in
+            zip(keys, np.split(order, splits))]
+
+    #Mutators
+    #Change the color of all the turtles, or the ones in which
+    #color is a Color, or an array of (red, green, blue) rows
+    def setColor(self, color, which = None):
+        if isinstance(color, Color):
+            color = color.getRGB()
+        self.colors[self.selected(which)] = np.clip(np.asarray(color), 0,\
+            255)
         self.update()
 
+    #Set the headings
+    def setHeading(self, heading):
+        self.headings = self.perTurtle(heading, "heading") % 360
+        self.update()
+
+    #Turn right by a number of degrees (negative turns left)
+    def turn(self, degrees = 90):
+        self.setHeading(self.headings + degrees)
+
+    #Lift or lower the pens of all the turtles, or the ones in which
+    def penUp(self, which = None):
+        self.pens[self.selected(which)] = False
+
+    def penDown(self, which = None):
+        self.pens[self.selected(which)] = True
+
+    #Move every turtle to its new (x, y), drawing the trails of those
+    #with their pens down
+    def moveTo(self, x, y):
+        newXs = self.perTurtle(x, "x")
+        newYs = self.perTurtle(y, "y")
+        #Don't leave the world, if that setting is on
+        if not WORLDS_ESCAPABLE:
+            np.clip(newXs, 0, self.picture.getWidth(), out=newXs)
+            np.clip(newYs, 0, self.picture.getHeight(), out=newYs)
+        if self.pens.any():
+            with self.picture.drawing() as d:
+                for col, items in self.colorGroups(self.pens):
+                    d.addLines(self.xs[items], self.ys[items],
+                        newXs[items], newYs[items], col)
+        self.xs = newXs
+        self.ys = newYs
+        self.update()
+
+    #Move each turtle forward by pixels (one number, or one per turtle)
+    def forward(self, pixels):
+        radians = np.radians(self.headings)
+        self.moveTo(self.xs + pixels * np.sin(radians),
+            self.ys - pixels * np.cos(radians))
+
+    def backward(self, pixels):
+        self.forward(-np.asarray(pixels, dtype=np.float64))
+
+    #Draw all the turtles as dots, with a darker dot for each head,
+    #using the open drawing context d
+    def drawSprites(self, d):
+        for col, items in self.colorGroups():
+            d.addDots(self.xs[items], self.ys[items], col, self.size)
+        radians = np.radians(self.headings)
+        reach = self.size * 0.5
+        d.addDots(self.xs + reach * np.sin(radians),
+            self.ys - reach * np.cos(radians), makeColor(0, 127, 0),
+            max(2, self.size // 3))
+
 #Turn the turtle right by the specified angle
 def turn(turtle, degrees=90):
     if not isinstance(turtle, Turtle):
@@ -3210,6 +5145,36 @@ def drop(turtle, picture):
     turtle.drop(picture)
 
 
+#Create a swarm of count turtles on the given World/Picture
+def makeSwarm(world, count):
+    if not (isinstance(world, World) or isinstance(world, Picture)):
+        repTypeError("makeSwarm(world, count): First input is not a world or picture")
+    if not isinstance(count, int) or count <= 0:
+        repValError("makeSwarm(world, count): Second input is not a positive integer")
+    return TurtleSwarm(world, count)
+
+#Start recording a turtle's moves (optionally into an existing recording)
+def startRecording(turtle, recording=None):
+    if not isinstance(turtle, Turtle):
+        repTypeError("startRecording(turtle[, recording]): First input is not a turtle")
+    if recording is not None and not isinstance(recording, TurtleRecording):
+        repTypeError("startRecording(turtle[, recording]): Second input is not a recording")
+    return turtle.startRecording(recording)
+
+#Stop recording a turtle's moves, and get the recording
+def stopRecording(turtle):
+    if not isinstance(turtle, Turtle):
+        repTypeError("stopRecording(turtle): Input is not a turtle")
+    return turtle.stopRecording()
+
+#Draw a recording on a picture of any size
+def replayRecording(recording, picture):
+    if not isinstance(recording, TurtleRecording):
+        repTypeError("replayRecording(recording, picture): First input is not a recording")
+    if not isinstance(picture, Picture):
+        repTypeError("replayRecording(recording, picture): Second input is not a picture")
+    recording.replay(picture)
+
 #Retrieve the turtle's x coordinate
 def getXPos(turtle):
     if not isinstance(turtle, Turtle):
@@ -3251,6 +5216,54 @@ def getTurtleList(world):
         repTypeError("getTurtleList(world): Input is not a world")
     return world.getTurtleList()
 
+#Record the world into a movie, a frame every time it's drawn (or every
+#every-th time); recordWorld(world, None) stops
+def recordWorld(world, movie, every=1):
+    if not isinstance(world, World):
+        repTypeError("recordWorld(world, movie[, every]): First input is not a world")
+    if movie is not None and not isinstance(movie, Movie):
+        repTypeError("recordWorld(world, movie[, every]): Second input is not a movie")
+    if not isinstance(every, int) or every <= 0:
+        repValError("recordWorld(world, movie[, every]): Third input is not a positive integer")
+    world.record(movie, every)
+
+#Get the turtles in the world within radius of (x, y), nearest first
+def turtlesNear(world, x, y, radius):
+    if not isinstance(world, World):
+        repTypeError("turtlesNear(world, x, y, radius): First input is not a world")
+    for value in (x, y, radius):
+        if not isinstance(value, numbers.Real):
+            repTypeError("turtlesNear(world, x, y, radius): x, y and radius must be numbers")
+    return world.turtlesNear(x, y, radius)
+
+#Get the turtle nearest to the given one in its world
+def nearestTurtle(turtle):
+    if not isinstance(turtle, Turtle):
+        repTypeError("nearestTurtle(turtle): Input is not a turtle")
+    if not isinstance(turtle.world, World):
+        repValError("nearestTurtle(turtle): The turtle is not in a world")
+    return turtle.world.nearestTurtle(turtle)
+
+#Draw the world only every n turtle steps (0: only on updateWorld), and
+#at most fps times a second
+def setTracer(world, n=1, fps=None):
+    if not isinstance(world, World):
+        repTypeError("setTracer(world[, n, fps]): First input is not a world")
+    if not isinstance(n, int) or n < 0:
+        repValError("setTracer(world[, n, fps]): Second input is not a non-negative integer")
+    if fps is not None:
+        if not isinstance(fps, numbers.Real):
+            repTypeError("setTracer(world[, n, fps]): Third input is not a number")
+        if fps <= 0:
+            repValError("setTracer(world[, n, fps]): Third input is not positive")
+    world.setTracer(n, fps)
+
+#Draw the world now, with all the turtle steps so far
+def updateWorld(world):
+    if not isinstance(world, World):
+        repTypeError("updateWorld(world): Input is not a world")
+    world.update()
+
 # end of stuff imported for worlds and turtles
 
 # used in the book
@@ -3266,16 +5279,942 @@ def printNow(output):
     """
     print(output)
 
+#Get a copy of a 32-bit QImage's pixel bytes
+def _imageBytes(image):
+    ptr = image.constBits()
+    if Qt_VERSION == 5:
+        ptr.setsize(image.sizeInBytes())
+        return ptr.asstring()
+    return bytes(ptr)
+
+#Make a 32-bit QImage (with its own copy of the data) from pixel bytes
+def _imageFromBytes(data, width, height, bytesPerLine):
+    return QtGui.QImage(data, width, height, bytesPerLine,
+        QtGui.QImage.Format_RGB32).copy()
+
+#XOR two equally long byte strings
+def _xorBytes(a, b):
+    if np is not None:
+        return np.bitwise_xor(np.frombuffer(a, dtype=np.uint8),
+            np.frombuffer(b, dtype=np.uint8)).tobytes()
+    return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).\
+        to_bytes(len(a), "little")
+
+#A movie frame kept in memory as the zlib-compressed XOR of its pixels with
+#the frame before it, so frames that hardly change take almost no room.
+#Every KEYFRAME_INTERVAL-th frame is stored whole, so getting a frame never
+#means undoing too many differences.
+class DeltaFrame:
+    KEYFRAME_INTERVAL = 30
+    #The most recently decoded frames' pixel bytes, by frame, up to
+    #DECODED_BYTES in total, so playing frames in order only undoes one
+    #difference each, and stepping back through them mostly doesn't have
+    #to go back to the keyframe. They're kept by weak references to the
+    #frames, so frames no one else uses (like a deleted movie's) still go
+    #away, taking their pixel bytes with them.
+    DECODED_BYTES = 64 * 1024 * 1024
+    decoded = collections.OrderedDict()
+    decodedBytes = 0
+    #Reentrant, since a frame can go away (and be forgotten) in the middle
+    #of changing decoded
+    lock = threading.RLock()
+
+    #Constructor
+    #image is the frame's picture (a QImage), previous the DeltaFrame
+    #before it (or None)
+    def __init__(self, image, previous = None):
+        if image.format() != QtGui.QImage.Format_RGB32:
+            image = image.convertToFormat(QtGui.QImage.Format_RGB32)
+        self.width = image.width()
+        self.height = image.height()
+        self.bytesPerLine = image.bytesPerLine()
+        #What the frame is kept in decoded by
+        self.ref = weakref.ref(self, DeltaFrame.forget)
+        raw = _imageBytes(image)
+        if previous is not None and\
+                previous.chain + 1 < self.KEYFRAME_INTERVAL and\
+                (previous.width, previous.height) == (self.width, self.height):
+            self.previous = previous
+            self.chain = previous.chain + 1
+            self.data = zlib.compress(_xorBytes(raw, previous.raw()), 1)
+        else:
+            self.previous = None
+            self.chain = 0
+            self.data = zlib.compress(raw, 1)
+        self.remember(raw)
+
+    def __str__(self):
+        return "Frame in memory, %d by %d, %d bytes" % (self.width,\
+            self.height, len(self.data))
+
+    #Memory the frame takes up
+    def nbytes(self):
+        return len(self.data)
+
+    #Get the frame's pixel bytes
+    def raw(self):
+        #Go back to the keyframe or the latest frame already decoded, then
+        #undo the differences from there
+        chain = []
+        frame = self
+        raw = None
+        while frame is not None:
+            with DeltaFrame.lock:
+                raw = DeltaFrame.decoded.get(frame.ref)
+                if raw is not None:
+                    DeltaFrame.decoded.move_to_end(frame.ref)
+                    break
+            chain.append(frame)
+            frame = frame.previous
+        for frame in reversed(chain):
+            if raw is None:
+                raw = zlib.decompress(frame.data)
+            else:
+                raw = _xorBytes(zlib.decompress(frame.data), raw)
+            frame.remember(raw)
+        return raw
+
+    #Keep the frame's pixel bytes among the recently decoded ones
+    def remember(self, raw):
+        with DeltaFrame.lock:
+            decoded = DeltaFrame.decoded
+            old = decoded.pop(self.ref, None)
+            if old is not None:
+                DeltaFrame.decodedBytes -= len(old)
+            decoded[self.ref] = raw
+            DeltaFrame.decodedBytes += len(raw)
+            while DeltaFrame.decodedBytes > self.DECODED_BYTES and\
+                    len(decoded) > 1:
+                DeltaFrame.decodedBytes -= len(decoded.popitem(last=False)[1])
+
+    #Forget a frame that's gone away (called with its ref)
+    @staticmethod
+    def forget(ref):
+        with DeltaFrame.lock:
+            raw = DeltaFrame.decoded.pop(ref, None)
+            if raw is not None:
+                DeltaFrame.decodedBytes -= len(raw)
+
+    #Get the frame as a QImage
+    def image(self):
+        return _imageFromBytes(self.raw(), self.width, self.height,\
+            self.bytesPerLine)
+
+#A movie frame kept in memory as it is
+class RawFrame:
+    #Constructor
+    def __init__(self, image):
+        #QImages share their data until one changes, so the picture it
+        #came from can keep changing without changing the frame
+        self.frame = QtGui.QImage(image)
+
+    def __str__(self):
+        return "Frame in memory, %d by %d" % (self.frame.width(),\
+            self.frame.height())
+
+    def nbytes(self):
+        return self.frame.sizeInBytes()
+
+    def image(self):
+        return self.frame
+
+#A movie frame kept in memory, zlib-compressed
+class CompressedFrame:
+    #Constructor
+    def __init__(self, image):
+        if image.format() != QtGui.QImage.Format_RGB32:
+            image = image.convertToFormat(QtGui.QImage.Format_RGB32)
+        self.width = image.width()
+        self.height = image.height()
+        self.bytesPerLine = image.bytesPerLine()
+        self.data = zlib.compress(_imageBytes(image), 1)
+
+    def __str__(self):
+        return "Compressed frame in memory, %d by %d, %d bytes" %\
+            (self.width, self.height, len(self.data))
+
+    def nbytes(self):
+        return len(self.data)
+
+    def image(self):
+        return _imageFromBytes(zlib.decompress(self.data), self.width,\
+            self.height, self.bytesPerLine)
+
+#A movie frame saved as a PNG in a temporary directory
+#directory is a tempfile.TemporaryDirectory; it's deleted once no frame
+#(or movie) uses it anymore
+class DiskFrame:
+    #Constructor
+    def __init__(self, image, directory, number):
+        self.directory = directory
+        self.filename = os.path.join(directory.name, "frame%06d.png" % number)
+        if not image.save(self.filename, "PNG"):
+            reportErrorToUser(IOError, "Saving a movie frame to " +\
+                self.filename + " failed")
+
+    def __str__(self):
+        return "Frame saved in " + self.filename
+
+    def nbytes(self):
+        return 0
+
+    def image(self):
+        return QtGui.QImage(self.filename)
+
+#Ways Movie can keep the Pictures added to it
+MOVIE_STORES = ("auto", "raw", "compressed", "delta", "disk")
+
+#Writes frames to a Motion-JPEG AVI file as they're added
+#Each frame is saved as a JPEG by Qt and written straight to the file;
+#all that's kept in memory is where each frame went, for the index at the
+#end. Call close() when done.
+#Sizes and offsets in the file are 32 bits, so it can't get bigger than
+#MAX_BYTES; a frame that would make it bigger is an error, and the frames
+#before it are left in a file that still plays.
+class AVIWriter:
+    #Flags in the AVI headers
+    AVIF_HASINDEX = 0x10
+    AVIIF_KEYFRAME = 0x10
+    MAX_BYTES = 0xFFFFFFFF
+
+    #Constructor
+    def __init__(self, path, width, height, framesPerSec = 16, quality = 90):
+        self.width = width
+        self.height = height
+        self.quality = quality
+        #Frame rate as a fraction, rate / scale
+        self.scale = 1000
+        self.rate = int(round(framesPerSec * 1000))
+        #Offset and size of each frame's data, for the index
+        self.offsets = array.array("I")
+        self.sizes = array.array("I")
+        self.largest = 0
+        self.file = open(path, "wb")
+        self.writeHeaders()
+
+    #Write a chunk header (four letter code and size)
+    def chunkHeader(self, fourcc, size):
+        self.file.write(fourcc + struct.pack("<I", size))
+
+    #Write the main header, stream header and stream format; the counts
+    #in them are filled in by close()
+    def writeHeaders(self):
+        f = self.file
+        f.write(b"RIFF\0\0\0\0AVI ")
+        self.chunkHeader(b"LIST", 4 + 8 + 56 + 8 + 4 + 8 + 56 + 8 + 40)
+        f.write(b"hdrl")
+        self.chunkHeader(b"avih", 56)
+        self.avihAt = f.tell()
+        f.write(self.mainHeader(0))
+        self.chunkHeader(b"LIST", 4 + 8 + 56 + 8 + 40)
+        f.write(b"strl")
+        self.chunkHeader(b"strh", 56)
+        self.strhAt = f.tell()
+        f.write(self.streamHeader(0))
+        self.chunkHeader(b"strf", 40)
+        #BITMAPINFOHEADER
+        f.write(struct.pack("<IiiHH4sIiiII", 40, self.width, self.height, 1,
+            24, b"MJPG", self.width * self.height * 3, 0, 0, 0, 0))
+        self.moviAt = f.tell()
+        f.write(b"LIST\0\0\0\0movi")
+
+    #The avih chunk's data
+    def mainHeader(self, frames):
+        return struct.pack("<14I", (1000000 * self.scale) // self.rate,
+            0, 0, self.AVIF_HASINDEX, frames, 0, 1, self.largest,
+            self.width, self.height, 0, 0, 0, 0)
+
+    #The strh chunk's data
+    def streamHeader(self, frames):
+        return struct.pack("<4s4sIHHIIIIIIIIhhhh", b"vids", b"MJPG", 0, 0,
+            0, 0, self.scale, self.rate, 0, frames, self.largest, 0xFFFFFFFF,
+            0, 0, 0, self.width, self.height)
+
+    #Add a frame (a QImage)
+    #Every frame is shown for the same time in an AVI, so duration (there
+    #so other movie writers can be swapped in) is ignored
+    def addFrame(self, image, duration = None):
+        if image.width() != self.width or image.height() != self.height:
+            image = image.scaled(self.width, self.height,
+                QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+        buf = QtCore.QBuffer()
+        buf.open(QtCore.QIODevice.WriteOnly)
+        if not image.save(buf, "JPG", self.quality):
+            reportErrorToUser(IOError, "Encoding a movie frame as JPEG failed")
+        data = bytes(buf.data())
+        buf.close()
+        #The chunk (padded to even length), and the index at the end with
+        #its entry for this frame, have to fit
+        end = self.file.tell() + 8 + len(data) + len(data) % 2 +\
+            8 + 16 * (len(self.offsets) + 1)
+        if end > self.MAX_BYTES:
+            self.close()
+            reportErrorToUser(IOError, "AVI files can't be bigger than 4 GB;"
+                " stopped after %d frames. Try a lower quality or frame size,"
+                " or write the frames to a directory." % len(self.sizes))
+        #Index offsets count from the "movi" code
+        self.offsets.append(self.file.tell() - (self.moviAt + 8))
+        self.sizes.append(len(data))
+        self.largest = max(self.largest, len(data))
+        self.chunkHeader(b"00dc", len(data))
+        self.file.write(data)
+        #Chunks start on even offsets
+        if len(data) % 2:
+            self.file.write(b"\0")
+
+    #Write the index, fill in the sizes and counts, and close the file
+    def close(self):
+        if self.file is None:
+            return
+        f = self.file
+        moviEnd = f.tell()
+        self.chunkHeader(b"idx1", 16 * len(self.offsets))
+        for offset, size in zip(self.offsets, self.sizes):
+            f.write(struct.pack("<4sIII", b"00dc", self.AVIIF_KEYFRAME,
+                offset, size))
+        end = f.tell()
+        f.seek(4)
+        f.write(struct.pack("<I", end - 8))
+        f.seek(self.moviAt + 4)
+        f.write(struct.pack("<I", moviEnd - (self.moviAt + 8)))
+        f.seek(self.avihAt)
+        f.write(self.mainHeader(len(self.offsets)))
+        f.seek(self.strhAt)
+        f.write(self.streamHeader(len(self.offsets)))
+        f.close()
+        self.file = None
+
+#Get a QImage's pixels as a height x width x 3 (red, green, blue) array
+def _imageRGB(image):
+    if image.format() != QtGui.QImage.Format_RGB32 and\
+            image.format() != QtGui.QImage.Format_ARGB32:
+        image = image.convertToFormat(QtGui.QImage.Format_RGB32)
+    return _imageView(image, False)[:, :, 2::-1].copy()
+
+#Bounding box (x, y, w, h) of the pixels where two RGB arrays differ, or
+#None if they're the same, along with the height x width mask of them
+def _changedBox(rgb, previous):
+    changed = (rgb != previous).any(axis=2)
+    rows = np.flatnonzero(changed.any(axis=1))
+    if len(rows) == 0:
+        return None, changed
+    cols = np.flatnonzero(changed.any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1),\
+        int(rows[-1] - rows[0] + 1)), changed
+
+#Pick a palette of up to count colors for an RGB array by median cut
+#Returns a count x 3 uint8 array
+def _medianCutPalette(rgb, count):
+    pixels = rgb.reshape(-1, 3)
+    #A sample is plenty to pick colors from
+    if len(pixels) > 65536:
+        pixels = pixels[::len(pixels) // 65536]
+    #Each box with the widest spread of one of its channels, and which
+    spreads = []
+    boxes = []
+    def addBox(box):
+        spread = box.max(axis=0).astype(int) - box.min(axis=0)
+        channel = int(spread.argmax())
+        spreads.append(int(spread[channel]))
+        boxes.append((box, channel))
+    addBox(pixels)
+    while len(boxes) < count:
+        #Split the box with the widest spread at its median
+        i = int(np.argmax(spreads))
+        if spreads[i] == 0:
+            break
+        spreads.pop(i)
+        box, channel = boxes.pop(i)
+        box = box[box[:, channel].argsort(kind="stable")]
+        half = len(box) // 2
+        addBox(box[:half])
+        addBox(box[half:])
+    palette = np.zeros((count, 3), dtype=np.uint8)
+    for i, (box, channel) in enumerate(boxes):
+        palette[i] = np.rint(box.mean(axis=0))
+    return palette
+
+#Lookup table from 5-bit-per-channel colors to the nearest palette entry
+#(among the first used entries)
+def _paletteLUT(palette, used):
+    levels = np.arange(32) * 8 + 4
+    r, g, b = np.meshgrid(levels, levels, levels, indexing="ij")
+    grid = np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+    colors = palette[:used].astype(np.int32)
+    best = np.zeros(len(grid), dtype=np.uint8)
+    bestDist = np.full(len(grid), np.iinfo(np.int32).max, dtype=np.int32)
+    for i, col in enumerate(colors):
+        dist = ((grid - col) ** 2).sum(axis=1)
+        closer = dist < bestDist
+        best[closer] = i
+        bestDist[closer] = dist[closer]
+    return best
+
+#LZW-compress palette indices for a GIF image, as data sub-blocks
+def _gifLZW(data, minCodeSize = 8):
+    clear = 1 << minCodeSize
+    end = clear + 1
+    out = bytearray()
+    bits = 0
+    bitCount = 0
+    codeSize = minCodeSize + 1
+    table = {}
+    nextCode = end + 1
+    #Write clear code first
+    bits |= clear << bitCount
+    bitCount += codeSize
+    prefix = data[0]
+    for byte in data[1:]:
+        key = (prefix << 8) | byte
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        bits |= prefix << bitCount
+        bitCount += codeSize
+        while bitCount >= 8:
+            out.append(bits & 255)
+            bits >>= 8
+            bitCount -= 8
+        if nextCode < 4096:
+            table[key] = nextCode
+            nextCode += 1
+            if nextCode > (1 << codeSize) and codeSize < 12:
+                codeSize += 1
+        else:
+            #Table full: start over
+            bits |= clear << bitCount
+            bitCount += codeSize
+            table = {}
+            nextCode = end + 1
+            codeSize = minCodeSize + 1
+        prefix = byte
+    bits |= prefix << bitCount
+    bitCount += codeSize
+    bits |= end << bitCount
+    bitCount += codeSize
+    while bitCount > 0:
+        out.append(bits & 255)
+        bits >>= 8
+        bitCount -= 8
+    blocks = bytearray([minCodeSize])
+    for i in range(0, len(out), 255):
+        chunk = out[i:i + 255]
+        blocks.append(len(chunk))
+        blocks.extend(chunk)
+    blocks.append(0)
+    return bytes(blocks)
+
+#Writes frames to an animated GIF file as they're added
+#Each frame after the first only stores the rectangle that changed, with
+#unchanged pixels in it left transparent. The palette is picked (by
+#median cut) from the first frame and kept for as long as it matches the
+#frames well; a frame it doesn't suit gets a new one, which is then kept
+#for the frames after it. Only the last frame is kept in memory.
+class GIFWriter:
+    #Palette index used for transparent pixels
+    TRANSPARENT = 255
+    #Average error (per channel) past which a frame gets a new palette
+    PALETTE_ERROR = 12
+
+    #Constructor
+    #loops is how many times to play (0 for forever)
+    def __init__(self, path, width, height, loops = 0):
+        _requireNumpy("GIFWriter()")
+        self.width = width
+        self.height = height
+        self.previous = None
+        self.palette = None
+        self.lut = None
+        #The first frame's palette, written as the file's global one
+        self.globalPalette = None
+        self.loops = loops
+        #Time so far, in hundredths of a second, so rounding doesn't add up
+        self.time = 0.
+        self.file = open(path, "wb")
+
+    #Make a palette (and its lookup table) for an RGB array
+    def newPalette(self, rgb):
+        self.palette = _medianCutPalette(rgb, self.TRANSPARENT)
+        self.lut = _paletteLUT(self.palette, self.TRANSPARENT)
+
+    #Palette indices for an RGB array
+    def indices(self, rgb):
+        rgb5 = rgb >> 3
+        return self.lut[(rgb5[..., 0].astype(np.int32) << 10) |
+            (rgb5[..., 1].astype(np.int32) << 5) | rgb5[..., 2]]
+
+    #Add a frame (a QImage) shown for duration seconds
+    #GIF delays are 16 bits, so a frame can't be shown for more than
+    #655.35 seconds
+    def addFrame(self, image, duration):
+        start = int(round(self.time))
+        delay = int(round(self.time + duration * 100)) - start
+        if delay > 0xFFFF:
+            repValError("Frames in an animated GIF can't be shown for more "
+                "than 655 seconds")
+        self.time += duration * 100
+        if image.width() != self.width or image.height() != self.height:
+            image = image.scaled(self.width, self.height,
+                QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+        rgb = _imageRGB(image)
+        if self.previous is None:
+            box = (0, 0, self.width, self.height)
+            changed = None
+        else:
+            box, changed = _changedBox(rgb, self.previous)
+            if box is None:
+                #Nothing changed: a single transparent pixel holds the time
+                box = (0, 0, 1, 1)
+        x, y, w, h = box
+        part = rgb[y:y + h, x:x + w]
+        f = self.file
+        if self.palette is None:
+            self.newPalette(part)
+            self.globalPalette = self.palette
+            f.write(b"GIF89a" + struct.pack("<HHBBB", self.width,
+                self.height, 0xf7, 0, 0))
+            f.write(self.paletteBytes())
+            #Loop forever (or loops times)
+            f.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01" +
+                struct.pack("<H", self.loops) + b"\0")
+        else:
+            #Keep the palette unless it's a poor match for what changed
+            mask = None if changed is None else changed[y:y + h, x:x + w]
+            used = part if mask is None else part[mask]
+            if len(used) > 0:
+                error = np.abs(self.palette[self.indices(used)].astype(int) -
+                    used).mean()
+                if error > self.PALETTE_ERROR:
+                    self.newPalette(used.reshape(-1, 1, 3))
+        indices = self.indices(part)
+        if changed is not None:
+            indices[~changed[y:y + h, x:x + w]] = self.TRANSPARENT
+        #Graphic control: leave the frame in place, maybe with transparency
+        f.write(b"\x21\xf9\x04" + struct.pack("<BHBB",
+            (1 << 2) | (1 if changed is not None else 0), delay,
+            self.TRANSPARENT, 0))
+        #Frames using the first frame's palette use the global one; a
+        #newer palette has to go with each frame that uses it
+        if self.palette is self.globalPalette:
+            f.write(b"\x2c" + struct.pack("<HHHHB", x, y, w, h, 0))
+        else:
+            f.write(b"\x2c" + struct.pack("<HHHHB", x, y, w, h, 0x87))
+            f.write(self.paletteBytes())
+        f.write(_gifLZW(indices.astype(np.uint8).tobytes()))
+        self.previous = rgb
+
+    #The current palette as a 256-color GIF color table
+    def paletteBytes(self):
+        colors = np.zeros((256, 3), dtype=np.uint8)
+        colors[:len(self.palette)] = self.palette
+        return colors.tobytes()
+
+    #Finish the file
+    def close(self):
+        if self.file is None:
+            return
+        self.file.write(b"\x3b")
+        self.file.close()
+        self.file = None
+
+#Writes frames to an animated PNG file as they're added
+#Like GIFWriter, each frame after the first only stores the rectangle that
+#changed, with unchanged pixels transparent, but colors are kept exactly.
+#The number of frames has to be known at the start.
+class APNGWriter:
+    #Constructor
+    def __init__(self, path, width, height, frameCount, loops = 0):
+        _requireNumpy("APNGWriter()")
+        self.width = width
+        self.height = height
+        self.previous = None
+        #Chunk sequence number, and time so far in milliseconds
+        self.sequence = 0
+        self.time = 0.
+        self.file = open(path, "wb")
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        #8-bit RGBA
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6,
+            0, 0, 0))
+        self.chunk(b"acTL", struct.pack(">II", frameCount, loops))
+
+    #Write a chunk
+    def chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)) + kind + data +
+            struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    #Add a frame (a QImage) shown for duration seconds
+    #Delays are a 16-bit fraction of a second: thousandths, or for long
+    #frames hundredths, tenths or whole seconds, up to 65535 seconds
+    def addFrame(self, image, duration):
+        start = int(round(self.time))
+        delay = int(round(self.time + duration * 1000)) - start
+        for denominator in (1000, 100, 10, 1):
+            numerator = int(round(delay * denominator / 1000.))
+            if numerator <= 0xFFFF:
+                break
+        else:
+            repValError("Frames in an animated PNG can't be shown for more "
+                "than 65535 seconds")
+        self.time += duration * 1000
+        if image.width() != self.width or image.height() != self.height:
+            image = image.scaled(self.width, self.height,
+                QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+        rgb = _imageRGB(image)
+        if self.previous is None:
+            box = (0, 0, self.width, self.height)
+            changed = None
+        else:
+            box, changed = _changedBox(rgb, self.previous)
+            if box is None:
+                box = (0, 0, 1, 1)
+        x, y, w, h = box
+        rgba = np.empty((h, w, 4), dtype=np.uint8)
+        rgba[:, :, :3] = rgb[y:y + h, x:x + w]
+        rgba[:, :, 3] = 255
+        if changed is not None:
+            rgba[:, :, 3][~changed[y:y + h, x:x + w]] = 0
+        #Each row starts with its filter type (0, none)
+        rows = np.zeros((h, 4 * w + 1), dtype=np.uint8)
+        rows[:, 1:] = rgba.reshape(h, 4 * w)
+        data = zlib.compress(rows.tobytes(), 6)
+        #Frame control: leave the frame in place, and draw it over the
+        #last one (except the first, which replaces everything)
+        self.chunk(b"fcTL", struct.pack(">IIIIIHHBB", self.sequence, w, h,
+            x, y, numerator, denominator, 0, 0 if changed is None else 1))
+        self.sequence += 1
+        if self.previous is None:
+            self.chunk(b"IDAT", data)
+        else:
+            self.chunk(b"fdAT", struct.pack(">I", self.sequence) + data)
+            self.sequence += 1
+        self.previous = rgb
+
+    #Finish the file
+    def close(self):
+        if self.file is None:
+            return
+        self.chunk(b"IEND", b"")
+        self.file.close()
+        self.file = None
+
+#Frame container files hold a whole movie: a header, the frames one after
+#another, an index saying where each frame is, and a footer saying where
+#the index is. Frames are either encoded image files (PNG, JPEG, ...)
+#copied as they are, or raw 32-bit pixels compressed with zlib.
+FRAME_CONTAINER_MAGIC = b"PYMFRAME"
+#Index entries: offset, size, format ("raw" or a file extension), width
+#and height
+FRAME_CONTAINER_ENTRY = struct.Struct("<QQ4sII")
+#Footer: index offset, number of frames, magic
+FRAME_CONTAINER_FOOTER = struct.Struct("<QQ8s")
+
+#A frame container file, opened for reading
+#The file is memory-mapped, so getting any frame is a direct lookup.
+#close() lets go of the file (a with block does it at the end); it's
+#opened again if frames are read after that.
+class FrameContainer:
+    #Constructor
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.map = None
+        self.open()
+
+    #Open and map the file, and read its footer
+    def open(self):
+        path = self.path
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        except ValueError:
+            self.map = None
+        size = 0 if self.map is None else len(self.map)
+        if size < len(FRAME_CONTAINER_MAGIC) + FRAME_CONTAINER_FOOTER.size\
+                or self.map[:len(FRAME_CONTAINER_MAGIC)] !=\
+                FRAME_CONTAINER_MAGIC:
+            self.close()
+            reportErrorToUser(IOError, path + " is not a frame container")
+        indexAt, self.count, magic = FRAME_CONTAINER_FOOTER.unpack_from(
+            self.map, size - FRAME_CONTAINER_FOOTER.size)
+        if magic != FRAME_CONTAINER_MAGIC:
+            self.close()
+            reportErrorToUser(IOError, path + " is not a complete frame "
+                "container")
+        self.indexAt = indexAt
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.close()
+        return False
+
+    #Whether path is this container's file
+    def isFile(self, path):
+        return os.path.exists(path) and os.path.exists(self.path) and\
+            os.path.samefile(path, self.path)
+
+    def __len__(self):
+        return self.count
+
+    def __str__(self):
+        return "Frame container %s, %d frames" % (self.path, self.count)
+
+    #Get the index entry for frame number index:
+    #(offset, size, format, width, height)
+    def entry(self, index):
+        if self.file is None:
+            self.open()
+        if not 0 <= index < self.count:
+            raise IndexError("frame container index out of range")
+        offset, size, fmt, width, height = FRAME_CONTAINER_ENTRY.unpack_from(
+            self.map, self.indexAt + index * FRAME_CONTAINER_ENTRY.size)
+        return offset, size, fmt.rstrip(b"\0").decode("ascii"), width,\
+            height
+
+    #Get the stored bytes of frame number index
+    def data(self, index):
+        offset, size, fmt, width, height = self.entry(index)
+        return self.map[offset:offset + size]
+
+    #Get frame number index as a QImage
+    def image(self, index):
+        offset, size, fmt, width, height = self.entry(index)
+        data = self.map[offset:offset + size]
+        if fmt == "raw":
+            return _imageFromBytes(zlib.decompress(data), width, height,
+                4 * width)
+        image = QtGui.QImage.fromData(data)
+        if image.isNull():
+            reportErrorToUser(IOError, "Frame %d of %s could not be read" %
+                (index, self.path))
+        return image
+
+    #Close the file
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+#A movie frame in a frame container
+class ContainerFrame:
+    #Constructor
+    def __init__(self, container, index):
+        self.container = container
+        self.index = index
+
+    def __str__(self):
+        return "Frame %d of %s" % (self.index, self.container.path)
+
+    #Frames stay in the file, not in memory
+    def nbytes(self):
+        return 0
+
+    def image(self):
+        return self.container.image(self.index)
+
+    #The frame's format: "raw", or the file extension it was encoded as
+    def format(self):
+        return self.container.entry(self.index)[2]
+
+    def isEncoded(self):
+        return self.format() != "raw"
+
+    #The frame's bytes as stored
+    def data(self):
+        return self.container.data(self.index)
+
+#Writes movie frames into a frame container file, one at a time
+#They go into a temporary file next to it, which only replaces the file
+#when close() is called, so a container being read from is never cut
+#short; discard() throws the temporary file away instead
+class FrameContainerWriter:
+    #Constructor
+    def __init__(self, path):
+        self.path = path
+        self.partial = path + ".part"
+        self.file = open(self.partial, "wb")
+        self.file.write(FRAME_CONTAINER_MAGIC)
+        self.index = []
+
+    #Add a frame: a filename, a Picture, or a movie frame
+    #Image files and encoded container frames are copied without decoding
+    def addFrame(self, frame):
+        width = height = 0
+        if isinstance(frame, str):
+            fmt = os.path.splitext(frame)[1][1:].lower()
+            with open(frame, "rb") as f:
+                data = f.read()
+        elif isinstance(frame, ContainerFrame) and frame.isEncoded():
+            fmt = frame.format()
+            data = frame.data()
+        else:
+            if isinstance(frame, Picture):
+                image = frame.image
+            else:
+                image = frame.image()
+            image = image.convertToFormat(QtGui.QImage.Format_RGB32)
+            fmt = "raw"
+            width = image.width()
+            height = image.height()
+            data = zlib.compress(_imageBytes(image), 1)
+        self.index.append((self.file.tell(), len(data),
+            fmt.encode("ascii")[:4], width, height))
+        self.file.write(data)
+
+    #Write the index and footer, and close the file
+    def close(self):
+        if self.file is None:
+            return
+        indexAt = self.file.tell()
+        for entry in self.index:
+            self.file.write(FRAME_CONTAINER_ENTRY.pack(*entry))
+        self.file.write(FRAME_CONTAINER_FOOTER.pack(indexAt, len(self.index),
+            FRAME_CONTAINER_MAGIC))
+        self.file.close()
+        self.file = None
+        os.replace(self.partial, self.path)
+
+    #Stop writing, and leave the file as it was
+    def discard(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        os.remove(self.partial)
+
+#Get a movie frame (a filename or a frame kept in memory) as a QImage
+def _frameImage(frame):
+    if isinstance(frame, str):
+        return QtGui.QImage(frame)
+    return frame.image()
+
+#Memory a movie frame takes up
+def _frameBytes(frame):
+    if isinstance(frame, str):
+        return 0
+    return frame.nbytes()
+
 class Movie(QtGui.QMovie):
     #TODO make the constructor accept different type of input.
-    #TODO writeFramesToDirectory
-    def __init__(self, frames = [], directory = None): # frames are filenames
+    #frames are filenames, or frames kept in memory (like DeltaFrame)
+    #Pictures added are kept as the store says: "raw" in memory as they
+    #are, "compressed" in memory, in memory as "delta"s from the frame
+    #before (see DeltaFrame), on "disk" in a temporary directory, or
+    #"auto": raw until the frames kept in memory take up half of
+    #memoryBudget bytes, then compressed until they take it all, then on disk
+    def __init__(self, frames = None, directory = None, store = "auto",\
+            memoryBudget = 512 * 1024 * 1024):
         super().__init__()
+        if store not in MOVIE_STORES:
+            repValError("Movie(): store must be one of " +\
+                ", ".join(MOVIE_STORES))
+        if frames is None:
+            frames = []
         self.frames = frames
         self.dir = directory
-
+        self.store = store
+        self.memoryBudget = memoryBudget
+        #Bytes of memory the frames take up
+        self.memoryUsed = 0
+        for frame in frames:
+            self.memoryUsed += _frameBytes(frame)
+        #Temporary directory for frames on disk, made when needed
+        self.spillDirectory = None
+        self.spilled = 0
+        #Seconds to show particular frames for, by frame; the rest are
+        #shown for one frame at the player's frame rate
+        self.durations = {}
+
+    #Add a frame: a filename, a Picture, or a frame kept in memory
     def addFrame(self, frame):
+        if isinstance(frame, Picture):
+            #setPixel writes through a cached scan line without telling Qt,
+            #so forget it; the next write then copies the shared pixels
+            #instead of changing this frame too
+            frame.lineindex = -1
+            frame = self.keepFrame(frame.image)
         self.frames.append(frame)
+        self.memoryUsed += _frameBytes(frame)
+        self.dir = None
+
+    #Make a frame for an image, kept the way the store says
+    def keepFrame(self, image):
+        store = self.store
+        if store == "auto":
+            #Raw frames only get half the budget, so there's room left for
+            #compressed ones
+            if self.memoryUsed + image.sizeInBytes() <=\
+                    self.memoryBudget // 2:
+                store = "raw"
+            else:
+                frame = CompressedFrame(image)
+                if self.memoryUsed + frame.nbytes() <= self.memoryBudget:
+                    return frame
+                store = "disk"
+        if store == "raw":
+            return RawFrame(image)
+        if store == "compressed":
+            return CompressedFrame(image)
+        if store == "delta":
+            previous = self.frames[-1] if self.frames else None
+            if not isinstance(previous, DeltaFrame):
+                previous = None
+            return DeltaFrame(image, previous)
+        if self.spillDirectory is None:
+            self.spillDirectory = tempfile.TemporaryDirectory(prefix="movie")
+        self.spilled += 1
+        return DiskFrame(image, self.spillDirectory, self.spilled)
+
+    #Show frame number index for seconds seconds when playing
+    #(None to go back to the player's frame rate)
+    def setFrameDuration(self, index, seconds):
+        if seconds is None:
+            self.durations.pop(self.frames[index], None)
+        else:
+            self.durations[self.frames[index]] = seconds
+
+    #How long frame number index is shown for, or default if it hasn't
+    #been set
+    def getFrameDuration(self, index, default = None):
+        return self.durations.get(self.frames[index], default)
+
+    #Get frame number index as a new Picture
+    def getPicture(self, index):
+        return Picture(QtGui.QImage(_frameImage(self.frames[index])))
+
+    #Remove a frame; the other frames are left as they are
+    def deleteFrame(self, index):
+        self.deleteFrames(index, index + 1)
+
+    #Remove frames start up to (not including) stop
+    def deleteFrames(self, start, stop):
+        removed = self.frames[start:stop]
+        for frame in removed:
+            self.memoryUsed -= _frameBytes(frame)
+        del self.frames[start:stop]
+        self.dir = None
+        #Let go of container files no frames are read from anymore
+        for container in self.containers(removed) - self.containers():
+            container.close()
+
+    #The frame containers that frames (default: all of the movie's frames)
+    #come from
+    def containers(self, frames = None):
+        if frames is None:
+            frames = self.frames
+        return set(frame.container for frame in frames
+            if isinstance(frame, ContainerFrame))
+
+    #Move a frame to a new position
+    def moveFrame(self, index, newIndex):
+        self.frames.insert(newIndex, self.frames.pop(index))
         self.dir = None
 
     def __len__(self):
@@ -3290,15 +6229,48 @@ class Movie(QtGui.QMovie):
     def __getitem__(self,item):
         return self.frames[item]
 
-    # def writeFramesToDirectory(self, directory):
-    #     import FrameSequencer
-    #     fs = FrameSequencer(directory)
-    #     #for frameindex in range(0, self.listModel.size()):
-    #         #fs.addFrame(Picture(self.listModel.get(frameindex)))
-    #         #fs.play(self.fps)
-    #     for frameindex in range(0, len(self.frames)):
-    #         fs.addFrame(Picture(self.frames[frameindex]))
-    #     self.dir = directory
+    #Write every frame to directory as frame0001.png, frame0002.jpg, ...
+    #Frames that are already encoded (files, or frames in a container) are
+    #copied as they are; the rest are saved as PNGs
+    def writeFramesToDirectory(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for i, frame in enumerate(self.frames):
+            name = os.path.join(directory, "frame%04d" % (i + 1))
+            if isinstance(frame, str):
+                shutil.copyfile(frame, name + os.path.splitext(frame)[1])
+            elif isinstance(frame, ContainerFrame) and frame.isEncoded():
+                with open(name + "." + frame.format(), "wb") as f:
+                    f.write(frame.data())
+            elif not _frameImage(frame).save(name + ".png", "PNG"):
+                reportErrorToUser(IOError, "Saving " + name + ".png failed")
+        self.dir = directory
+
+    #Write all the frames into one frame container file (see
+    #FrameContainer), which opens fast and seeks straight to any frame
+    #If frames come from the file being written, they're read from the
+    #new file afterwards
+    def writeFrameContainer(self, path):
+        writer = FrameContainerWriter(path)
+        try:
+            for frame in self.frames:
+                writer.addFrame(frame)
+        except BaseException:
+            writer.discard()
+            raise
+        replaced = [container for container in self.containers()
+            if container.isFile(path)]
+        #The file can't be replaced while it's open (on Windows)
+        for container in replaced:
+            container.close()
+        writer.close()
+        if replaced:
+            container = FrameContainer(path)
+            for i, frame in enumerate(self.frames):
+                if isinstance(frame, ContainerFrame) and\
+                        frame.container in replaced:
+                    frame.container = container
+                    frame.index = i
 
     def play(self):
         MoviePlayer(self).playMovie()
@@ -3344,42 +6316,76 @@ class Movie(QtGui.QMovie):
     #     writer = MovieWriter(self.dir, framesPerSec, destPath)
     #     writer.writeQuicktime()
         
-    # def writeAVI(self, destPath, framesPerSec = 16):
-    #     global mediaFolder
-    #     if not os.path.isabs(destPath):
-    #         destPath = mediaFolder + destPath
-    #     destPath = "file://"+destPath
-    #     if framesPerSec <= 0:
-    #         print("writeAVI(path[, framesPerSec]): Frame Rate must be a positive number")
-    #         raise ValueError
-    #     if self.frames == []: #Is movie empty?
-    #         print("writeAVI(path[, framesPerSec]): Movie has no frames. Cannot write empty Movie")
-    #         raise ValueError
-    #     elif self.dir == None and len(self.frames) == 1: #Is movie only 1 frame but never written out
-    #         frame = self.frames[0]
-    #         self.dir = frame[:(frame.rfind(os.sep))]
-    #     elif self.dir == None and len(self.frames) > 1: #Are movie frames all in the same directory? 
-    #         sameDir = 1
-    #         frame = self.frames[0]
-    #         frame = frame.replace('/', os.sep)
-    #         framesDir = frame[:(frame.rfind(os.sep))] #Parse directory of first frame
-    #         thisDir = framesDir
-    #         frameNum = 1
-    #         while(sameDir and frameNum < len(self.frames)):
-    #             frame = self.frames[frameNum]
-    #             frame = frame.replace('/', os.sep)
-    #             thisDir = frame[:(frame.rfind(os.sep))]
-    #             frameNum = frameNum+1
-    #             if(framesDir != thisDir):
-    #                 sameDir = 0
-    #         if(sameDir): #Loop ended because we ran out of frames
-    #             self.dir = framesDir
-    #         else: #Loop ended because sameDir became false
-    #             print("writeAVI(path[, framesPerSec]): Your frames are in different directories. Call writeFramesToDirectory() first, then try again.")
-    #             raise ValueError
-    #     writer = MovieWriter(self.dir, framesPerSec, destPath)
-    #     writer.writeAVI()
+    #Write the movie out as a Motion-JPEG AVI file
+    #Frames are read and written one at a time, so even long movies don't
+    #need much memory; frames of a different size are scaled to the first
+    def writeAVI(self, destPath, framesPerSec = 16, quality = 90):
+        self.writeAnimation("writeAVI", destPath, framesPerSec,
+            lambda path, width, height: AVIWriter(path, width, height,
+                framesPerSec, quality))
+
+    #Write the movie out as an animated GIF, frame by frame
+    #Frames with their own durations (see setFrameDuration) keep them
+    def writeAnimatedGIF(self, destPath, framesPerSec = 16):
+        self.writeAnimation("writeAnimatedGIF", destPath, framesPerSec,
+            lambda path, width, height: GIFWriter(path, width, height))
+
+    #Write the movie out as an animated PNG, frame by frame
+    def writeAnimatedPNG(self, destPath, framesPerSec = 16):
+        self.writeAnimation("writeAnimatedPNG", destPath, framesPerSec,
+            lambda path, width, height: APNGWriter(path, width, height,
+                len(self.frames)))
+
+    #Write the frames with a writer made by makeWriter(path, width, height)
+    def writeAnimation(self, funcName, destPath, framesPerSec, makeWriter):
+        if not os.path.isabs(destPath):
+            destPath = mediaFolder + destPath
+        if framesPerSec <= 0:
+            repValError(funcName + "(path[, framesPerSec]): Frame Rate must be a positive number")
+        if self.frames == []:
+            repValError(funcName + "(path[, framesPerSec]): Movie has no frames. Cannot write empty Movie")
+        first = _frameImage(self.frames[0])
+        writer = makeWriter(destPath, first.width(), first.height())
+        try:
+            for i, frame in enumerate(self.frames):
+                image = first if i == 0 else _frameImage(frame)
+                writer.addFrame(image,
+                    self.getFrameDuration(i, 1.0 / framesPerSec))
+        finally:
+            writer.close()
+
+
+#Done
+def writeAnimatedGIF(movie, destPath, framesPerSec = 16):
+    """
+        Takes a Movie object, a filename and (optionally) a frame rate as
+        input, and writes the movie out as an animated GIF.
+
+        :param movie: the movie object to be written
+        :param destPath: the path to the GIF file to write
+        :param framesPerSec: how many frames to show per second (optional)
+    """
+    if not (isinstance(movie, Movie)):
+        repTypeError("writeAnimatedGIF(movie, path[, framesPerSec]): First input is not a Movie")
+    if not isinstance(framesPerSec, numbers.Real) or framesPerSec <= 0:
+        repValError("writeAnimatedGIF(movie, path[, framesPerSec]): Frame rate must be a positive number")
+    movie.writeAnimatedGIF(destPath, framesPerSec)
+
+#Done
+def writeAnimatedPNG(movie, destPath, framesPerSec = 16):
+    """
+        Takes a Movie object, a filename and (optionally) a frame rate as
+        input, and writes the movie out as an animated PNG.
 
+        :param movie: the movie object to be written
+        :param destPath: the path to the PNG file to write
+        :param framesPerSec: how many frames to show per second (optional)
+    """
+    if not (isinstance(movie, Movie)):
+        repTypeError("writeAnimatedPNG(movie, path[, framesPerSec]): First input is not a Movie")
+    if not isinstance(framesPerSec, numbers.Real) or framesPerSec <= 0:
+        repValError("writeAnimatedPNG(movie, path[, framesPerSec]): Frame rate must be a positive number")
+    movie.writeAnimatedPNG(destPath, framesPerSec)
 
 #Done
 def playMovie(movie):
@@ -3403,63 +6409,152 @@ def playMovie(movie):
 #         raise ValueError
 #     movie.writeQuicktime(destPath, framesPerSec)
 # 
-# #Done
-# def writeAVI(movie, destPath, framesPerSec = 16):
-#     if not (isinstance(movie, Movie)):
-#         print("writeAVI(movie, path[, framesPerSec]): First input is not a Movie")
-#         raise ValueError
-#     if framesPerSec <= 0:
-#         print("writeAVI(movie, path[, framesPerSec]): Frame rate must be a positive number")
-#         raise ValueError
-#     movie.writeAVI(destPath, framesPerSec)
-# 
 #Done
-def makeMovie():
+def writeAVI(movie, destPath, framesPerSec = 16):
+    """
+        Takes a Movie object, a filename and (optionally) a frame rate as
+        input, and writes the movie out as a Motion-JPEG AVI file.
+
+        :param movie: the movie object to be written
+        :param destPath: the path to the AVI file to write
+        :param framesPerSec: how many frames to show per second (optional)
+    """
+    if not (isinstance(movie, Movie)):
+        repTypeError("writeAVI(movie, path[, framesPerSec]): First input is not a Movie")
+    if not isinstance(framesPerSec, numbers.Real) or framesPerSec <= 0:
+        repValError("writeAVI(movie, path[, framesPerSec]): Frame rate must be a positive number")
+    movie.writeAVI(destPath, framesPerSec)
+
+#Done
+def makeMovie(store = "auto"):
     """
+        Makes an empty Movie object. Pictures added to it are kept as store
+        says: "raw" as they are, "compressed", "delta" (compressed as the
+        changes from the frame before), "disk" in temporary files, or
+        "auto" to start raw and switch when they take up too much memory.
+
+        :param store: how the movie keeps the pictures added to it (optional)
         :return: an empty Movie object
     """
-    return Movie()
+    if store not in MOVIE_STORES:
+        repValError("makeMovie(store): store must be one of " +\
+            ", ".join(MOVIE_STORES))
+    return Movie(store=store)
 
 
 #Done
-def makeMovieFromInitialFile(filename):
+def makeMovieFromInitialFile(filename, lazy=False):
     """
         Takes a filename as input. Returns a Movie object using the given file
         as the first frame and using sequentially named files for subsequent
-        frames (i.e. frame001, frame002, etc.)
+        frames (i.e. frame001, frame002, etc.), in numeric order. The
+        filename can also be a pattern like frame%04d.png.
 
-        :param filename: string path to the first frame of the movie
+        :param filename: string path to the first frame of the movie, or a
+                         printf-style pattern for the frames' names
+        :param lazy: if True, don't look through the whole directory; assume
+                     the frames are numbered with no gaps (optional)
         :return: a Movie object using the given file as the first frame
     """
-    import re
-    movie = Movie()
-
     #filename = filename.replace(os.altsep, os.sep)
     filename = filename.replace('/',os.sep) #Hack fix because os.altsep is not defined for Windows as of Python 2.2
     sep_location = filename.rfind(os.sep)
     if(-1 == sep_location):
         filename = mediaFolder + filename
 
-    movie.directory = filename[:(filename.rfind(os.sep))]
-    movie.init_file = filename[(filename.rfind(os.sep))+1:]
-    regex = re.compile('[0-9]+')
-    file_regex = regex.sub('.*', movie.init_file)
-
-    for item in os.listdir(movie.directory):
-        if re.match(file_regex, item):
-            movie.addFrame(movie.directory + os.sep + item)
-
+    directory = filename[:(filename.rfind(os.sep))]
+    init_file = filename[(filename.rfind(os.sep))+1:]
+    if lazy:
+        frames = _probeFrames(directory, init_file)
+    else:
+        frames = _scanFrames(directory, init_file)
+    movie = Movie(frames)
+    movie.directory = directory
+    movie.init_file = init_file
     return movie
 
+#Split a frame name into the part before the frame number, a printf-style
+#format for the number, the part after, and the first frame's number
+#(None for a pattern like frame%04d.png); None if there's no number
+def _frameNameParts(name):
+    match = re.search(r"%(0?)(\d*)d", name)
+    if match is not None:
+        return name[:match.start()], match.group(), name[match.end():], None
+    matches = list(re.finditer(r"[0-9]+", name))
+    if not matches:
+        return None
+    #The frame number is the last number in the name
+    match = matches[-1]
+    digits = match.group()
+    if digits.startswith("0") and len(digits) > 1:
+        fmt = "%%0%dd" % len(digits)
+    else:
+        fmt = "%d"
+    return name[:match.start()], fmt, name[match.end():], int(digits)
+
+#Find the frames named like name in directory, in one pass over the
+#directory, sorted by frame number
+def _scanFrames(directory, name):
+    parts = _frameNameParts(name)
+    if parts is None:
+        return [os.path.join(directory, name)]
+    before, fmt, after, first = parts
+    width = re.match(r"%0(\d+)d", fmt)
+    if width is not None and first is None:
+        digits = "([0-9]{%s})" % width.group(1)
+    else:
+        digits = "([0-9]+)"
+    regex = re.compile(re.escape(before) + digits + re.escape(after) + "$")
+    found = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            match = regex.match(entry.name)
+            if match is None:
+                continue
+            number = int(match.group(1))
+            if first is None or number >= first:
+                found.append((number, entry.name))
+    found.sort()
+    return [os.path.join(directory, item) for number, item in found]
+
+#Find the frames named like name in directory without listing it, by
+#checking which numbers exist; frames must be numbered with no gaps
+def _probeFrames(directory, name):
+    parts = _frameNameParts(name)
+    if parts is None:
+        return [os.path.join(directory, name)]
+    before, fmt, after, first = parts
+    def path(number):
+        return os.path.join(directory, before + fmt % number + after)
+    if first is None:
+        #Patterns can start at 0 or 1
+        first = 0 if os.path.exists(path(0)) else 1
+    if not os.path.exists(path(first)):
+        return []
+    #Double the count until a frame is missing, then narrow it down
+    low = 1
+    high = 2
+    while os.path.exists(path(first + high - 1)):
+        low = high
+        high *= 2
+    while high - low > 1:
+        middle = (low + high) // 2
+        if os.path.exists(path(first + middle - 1)):
+            low = middle
+        else:
+            high = middle
+    return [path(first + i) for i in range(low)]
+
 
 #Done
 def addFrameToMovie(frame, movie):
     """
-        Takes a filename and a Movie object as input. Adds the file as a frame
-        to the end of the movie. addFrameToMovie(movie, frame) is also
-        acceptable.
+        Takes a filename (or a picture) and a Movie object as input. Adds the
+        file or picture as a frame to the end of the movie.
+        addFrameToMovie(movie, frame) is also acceptable.
         
-        :param frame: the filename of the frame to be added to the movie
+        :param frame: the filename of the frame (or the picture) to be added
+                      to the movie
         :param movie: the movie object for the frame to be added to
     """
     # frame = None
@@ -3471,24 +6566,364 @@ def addFrameToMovie(frame, movie):
     #     movie = b
     #     frame = a
 
-    if not (isinstance(movie,Movie) and isinstance(frame, str)):
+    if isinstance(frame, Movie) and not isinstance(movie, Movie):
+        frame, movie = movie, frame
+    if not (isinstance(movie,Movie) and isinstance(frame, (str, Picture))):
     # if movie.__class__ != Movie or frame.__class__ != String:
-        repValError("addFrameToMovie(frame, movie): frame is not a string or movie is not a Movie objectd")
+        repValError("addFrameToMovie(frame, movie): frame is not a string or picture, or movie is not a Movie object")
 
     movie.addFrame(frame)
 
-# #Done
-# def writeFramesToDirectory(movie, directory=None):
-#     if not isinstance(movie, Movie):
-#         print("writeFramesToDirectory(movie[, directory]): movie is not a Movie object")
-#         raise ValueError
-# 
-#     if directory == None:
-#         directory = user.home
-# 
-#     movie.writeFramesToDirectory(directory)
+#Done
+def writeFramesToDirectory(movie, directory=None):
+    """
+        Takes a Movie object and (optionally) a directory as input, and
+        writes each frame into the directory as frame0001, frame0002, etc.
+        The directory defaults to the media folder.
+
+        :param movie: the movie object whose frames are written
+        :param directory: the directory to write the frames to (optional)
+    """
+    if not isinstance(movie, Movie):
+        repTypeError("writeFramesToDirectory(movie[, directory]): movie is not a Movie object")
+
+    if directory == None:
+        directory = mediaFolder
+
+    movie.writeFramesToDirectory(directory)
+
+#Done
+def writeFrameContainer(movie, path):
+    """
+        Takes a Movie object and a filename as input, and writes all of the
+        movie's frames into that one file. Movies opened from the file with
+        makeMovieFromContainer open right away, however long they are.
+
+        :param movie: the movie object whose frames are written
+        :param path: the path to the frame container file to write
+    """
+    if not isinstance(movie, Movie):
+        repTypeError("writeFrameContainer(movie, path): First input is not a Movie object")
+    if not os.path.isabs(path):
+        path = mediaFolder + path
+    movie.writeFrameContainer(path)
+
+#Done
+def makeMovieFromContainer(path):
+    """
+        Takes a filename as input, and returns a Movie object with the
+        frames in that frame container file (see writeFrameContainer).
+        Frames are only read from the file when they're needed.
+
+        :param path: the path to the frame container file
+        :return: a Movie object with the frames in the file
+    """
+    if not isinstance(path, str):
+        repTypeError("makeMovieFromContainer(path): Input is not a string")
+    if not os.path.isabs(path):
+        path = mediaFolder + path
+    container = FrameContainer(path)
+    return Movie([ContainerFrame(container, i)
+        for i in range(len(container))])
+
+#Done
+def renderMovie(frameFunc, nFrames, workers = None, directory = None,\
+        showProgress = True):
+    """
+        Takes a function and a number of frames as input. Calls the function
+        with each frame number (0, 1, 2, ...) in separate processes at the
+        same time, and returns a Movie of the pictures it returns, in order.
+        If a directory is given, the frames are written there as frame0001.png,
+        frame0002.png, etc., and frames already there aren't made again, so a
+        render that was stopped can pick up where it left off.
+        The function has to be defined at the top level of a file (not a
+        lambda), and the code that calls renderMovie should be under
+        if __name__ == "__main__": so the other processes don't run it too.
+
+        :param frameFunc: function taking a frame number and returning a
+                          Picture
+        :param nFrames: the number of frames to make
+        :param workers: the number of processes to use; defaults to one per
+                        processor, and 1 renders without other processes
+                        (optional)
+        :param directory: the directory to write the frames to (optional)
+        :param showProgress: whether to print how many frames are done
+                             (optional)
+        :return: a Movie object with the frames
+    """
+    if not callable(frameFunc):
+        repTypeError("renderMovie(frameFunc, nFrames): First input is not a function")
+    if not isinstance(nFrames, int) or nFrames < 0:
+        repValError("renderMovie(frameFunc, nFrames): Second input is not a number of frames")
+    if workers == None:
+        workers = os.cpu_count() or 1
+    if directory != None:
+        if not os.path.isabs(directory):
+            directory = mediaFolder + directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        paths = [os.path.join(directory, "frame%04d.png" % (i + 1))
+            for i in range(nFrames)]
+    else:
+        paths = [None] * nFrames
+
+    movie = Movie()
+    #Rendered frames, by frame number, until the ones before them are done
+    done = {}
+    todo = []
+    for index in range(nFrames):
+        if paths[index] != None and os.path.exists(paths[index]):
+            done[index] = paths[index]
+        else:
+            todo.append(index)
+    added = 0
+    finished = len(done)
+    #Add frames to the movie in order as soon as they can be
+    def addDone():
+        nonlocal added
+        while added in done:
+            result = done.pop(added)
+            if directory != None:
+                movie.addFrame(result)
+            else:
+                movie.addFrame(movie.keepFrame(_imageFromBytes(*result)))
+            added += 1
+    def collect(index, result):
+        nonlocal finished
+        if result is None:
+            repValError("renderMovie(frameFunc, nFrames): frameFunc(" +\
+                str(index) + ") didn't return a picture")
+        done[index] = result
+        addDone()
+        finished += 1
+        if showProgress:
+            sys.stdout.write("\rRendered %d of %d frames" %\
+                (finished, nFrames))
+            sys.stdout.flush()
+
+    addDone()
+    if workers <= 1:
+        for index in todo:
+            collect(index, _renderFrame(frameFunc, index, paths[index]))
+    else:
+        #Start fresh processes: forking one that's running Qt isn't safe
+        pool = concurrent.futures.ProcessPoolExecutor(workers,\
+            mp_context=multiprocessing.get_context("spawn"))
+        try:
+            futures = {pool.submit(_renderFrame, frameFunc, index,\
+                paths[index]): index for index in todo}
+            for future in concurrent.futures.as_completed(futures):
+                collect(futures[future], future.result())
+        finally:
+            pool.shutdown(cancel_futures=True)
+    if todo and showProgress:
+        sys.stdout.write("\n")
+    if directory != None:
+        movie.dir = directory
+    return movie
+
+#Make frame number index for renderMovie, in whatever process runs it
+#With a path, the frame is saved there and the path is returned; otherwise
+#its pixels are returned as (data, width, height, bytesPerLine)
+#Returns None if frameFunc doesn't give back a Picture
+def _renderFrame(frameFunc, index, path):
+    picture = frameFunc(index)
+    if not isinstance(picture, Picture):
+        return None
+    image = picture.image
+    if path is None:
+        if image.format() != QtGui.QImage.Format_RGB32:
+            image = image.convertToFormat(QtGui.QImage.Format_RGB32)
+        return (_imageBytes(image), image.width(), image.height(),\
+            image.bytesPerLine())
+    #Save under another name first, so a render that's stopped partway
+    #never leaves a half-written frame that would be skipped next time
+    partial = path + ".part"
+    if not image.save(partial, "PNG"):
+        raise IOError("Saving " + path + " failed")
+    os.replace(partial, path)
+    return path
         
         
+#Decoded movie frames (QImages), by frame, keeping the most recently used
+#ones up to maxBytes in total. Safe to use from more than one thread.
+class FrameCache:
+    #Constructor
+    def __init__(self, maxBytes = 256 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self.images = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, frame):
+        with self.lock:
+            return frame in self.images
+
+    #Get a frame's decoded image, or None if it isn't here
+    def get(self, frame):
+        with self.lock:
+            image = self.images.get(frame)
+            if image is not None:
+                self.images.move_to_end(frame)
+            return image
+
+    #Keep a frame's decoded image, forgetting the least recently used ones
+    #if that's too many bytes
+    def put(self, frame, image):
+        with self.lock:
+            old = self.images.pop(frame, None)
+            if old is not None:
+                self.bytes -= old.sizeInBytes()
+            self.images[frame] = image
+            self.bytes += image.sizeInBytes()
+            #Always keep the newest one, even if it's too big on its own
+            while self.bytes > self.maxBytes and len(self.images) > 1:
+                frame, old = self.images.popitem(last=False)
+                self.bytes -= old.sizeInBytes()
+
+    #Get a frame's decoded image, decoding it if it isn't here
+    def image(self, frame):
+        image = self.get(frame)
+        if image is None:
+            image = _frameImage(frame)
+            self.put(frame, image)
+        return image
+
+    #Forget every frame not in frames
+    def keepOnly(self, frames):
+        kept = set(frames)
+        with self.lock:
+            for frame in list(self.images):
+                if frame not in kept:
+                    self.bytes -= self.images.pop(frame).sizeInBytes()
+
+#Background thread that decodes movie frames into a FrameCache before
+#they're needed, so playing doesn't wait on decoding
+class FramePrefetcher:
+    #Constructor
+    #ahead is how many frames players should ask for at a time
+    def __init__(self, cache, ahead = 8):
+        self.cache = cache
+        self.ahead = ahead
+        self.wanted = collections.deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    #Decode these frames, in order, instead of any still waiting
+    def prefetch(self, frames):
+        with self.condition:
+            self.wanted = collections.deque(frames)
+            self.condition.notify()
+
+    #Stop the thread
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.wanted.clear()
+            self.condition.notify()
+
+    #What the thread does
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.wanted:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                frame = self.wanted.popleft()
+            if frame not in self.cache:
+                try:
+                    self.cache.put(frame, _frameImage(frame))
+                except Exception:
+                    #The player will run into it (and report it) itself
+                    pass
+
+#Plays frames on time using a QTimer and a monotonic clock
+#Each tick shows the frame that should be on screen right then, skipping
+#(dropping) any whose time has already passed, so a slow frame never
+#makes the rest of the movie late
+class PlaybackScheduler:
+    #Constructor
+    #show(index) puts a frame on screen; finished() is called at the end
+    def __init__(self, show, finished = None):
+        self.show = show
+        self.finished = finished
+        self.timer = QtCore.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self.timer.timeout.connect(self.tick)
+        self.playing = False
+        self.shown = 0
+        self.dropped = 0
+        self.startTime = 0.
+        self.endTime = 0.
+
+    #Start playing; durations holds how many seconds to show each frame
+    def play(self, durations, start = 0):
+        #When each frame is due, from the start of playing
+        self.dueTimes = [0.]
+        for duration in durations[start:]:
+            self.dueTimes.append(self.dueTimes[-1] + duration)
+        self.first = start
+        self.index = 0
+        self.shown = 0
+        self.dropped = 0
+        self.playing = len(self.dueTimes) > 1
+        self.startTime = time.monotonic()
+        self.endTime = self.startTime
+        if self.playing:
+            self.tick()
+        elif self.finished is not None:
+            self.finished()
+
+    #Stop playing
+    def stop(self):
+        self.timer.stop()
+        if self.playing:
+            self.playing = False
+            self.endTime = time.monotonic()
+
+    #Show the frame that's due now, and set the timer for the next one
+    def tick(self):
+        last = len(self.dueTimes) - 1
+        if self.index >= last:
+            #The last frame has had its time on screen
+            self.finish()
+            return
+        now = time.monotonic() - self.startTime
+        #Skip frames whose time is already over
+        index = self.index
+        while index + 1 < last and self.dueTimes[index + 1] <= now:
+            index += 1
+        self.dropped += index - self.index
+        self.show(self.first + index)
+        self.shown += 1
+        self.index = index + 1
+        wait = self.dueTimes[self.index] - (time.monotonic() - self.startTime)
+        self.timer.start(max(0, int(round(wait * 1000))))
+
+    #Done playing
+    def finish(self):
+        self.playing = False
+        self.endTime = time.monotonic()
+        if self.finished is not None:
+            self.finished()
+
+    #Frames actually shown per second, so far
+    def achievedFps(self):
+        if self.playing:
+            elapsed = time.monotonic() - self.startTime
+        else:
+            elapsed = self.endTime - self.startTime
+        if elapsed <= 0:
+            return 0.
+        return self.shown / elapsed
+
 class MoviePlayer(QtWidgets.QWidget):
     PIC_WIDTH = 1000
     PIC_HEIGHT = 470
@@ -3498,19 +6933,23 @@ class MoviePlayer(QtWidgets.QWidget):
     #Should create window, populate with default values
     #remember it globally (to avoid garbage collection issues)
     #and show it
-    def __init__(self, movie = Movie(), dictionary = None):
+    #cacheBytes is how much memory decoded frames can take up
+    def __init__(self, movie = Movie(), dictionary = None,\
+            cacheBytes = 256 * 1024 * 1024):
         super().__init__()
                
         self.dictionary = dictionary
         self.movie = movie
         self.movieList = movie.frames
-        self.movie.setCacheMode(QtGui.QMovie.CacheAll)
-        
-        self.updateBuffer()
+        #Decoded frames, and a thread that decodes the next few frames
+        #before they're needed
+        self.cache = FrameCache(cacheBytes)
+        self.prefetcher = FramePrefetcher(self.cache)
+        self.scheduler = PlaybackScheduler(self.goToFrame, self.donePlaying)
             
         self.framesPerSec = 16
         self.numberFrame = len(self.movieList)
-        self.curentFrameNumber = self.movie.currentFrameNumber() - 1
+        self.curentFrameNumber = 0
         self.block_edit = False
                
         self.setWindowTitle("Movie Player" )
@@ -3532,21 +6971,35 @@ class MoviePlayer(QtWidgets.QWidget):
         self.activateWindow()
         QtWidgets.QApplication.processEvents()
     
-    # Maybe not efficient TODO
-    def updateBuffer(self): 
-        self.buf = QtCore.QBuffer() #Device holding frame in format
-        self.buf.open(QtCore.QIODevice.WriteOnly)    
-        for i in range(len(self.movieList)):
-            frame = self.movieList[i]
-            image = QtGui.QImage(frame)
-            image.save(self.buf, 'JPG')
-        self.buf.close()
-        self.movie.setDevice(self.buf)
+    # Get frame number index as a QPixmap, and have the frames after it
+    # decoded in the background
+    def framePixmap(self, index):
+        image = self.cache.image(self.movieList[index])
+        ahead = [self.movieList[(index + i) % self.numberFrame]
+            for i in range(1, min(self.prefetcher.ahead, self.numberFrame))]
+        self.prefetcher.prefetch(ahead)
+        return QtGui.QPixmap.fromImage(image)
+    
+    # Forget the decoded frames that aren't in the movie anymore
+    def forgetRemoved(self):
+        self.cache.keepOnly(self.movieList)
+    
+    # Stop the decoding thread when the window closes, and let go of the
+    # decoded frames (the player itself is kept around)
+    def closeEvent(self, event):
+        self.scheduler.stop()
+        self.prefetcher.stop()
+        # It may be partway through a frame it'll put in the cache
+        self.prefetcher.thread.join()
+        self.cache.keepOnly([])
+        super().closeEvent(event)
     
     def updateStuff(self):
-        self.curentFrameNumber = self.movie.currentFrameNumber()
         self.numberFrame = len(self.movieList)
         if (self.numberFrame != 0):
+            self.curentFrameNumber = max(0, min(self.curentFrameNumber,
+                self.numberFrame - 1))
+            self.movieLabel.setPixmap(self.framePixmap(self.curentFrameNumber))
             self.numLabel.setText("Frame Number " + str(self.curentFrameNumber))
         else:
             self.numLabel.setText("Frame Number ")
@@ -3558,7 +7011,8 @@ class MoviePlayer(QtWidgets.QWidget):
     
     # Method to jump to frame number frameNumber.
     def goToFrame(self, frameNumber):
-        self.movie.jumpToFrame(frameNumber)
+        self.curentFrameNumber = frameNumber
+        self.updateStuff()
     
     # Method to show the next image
     def showNext(self):
@@ -3580,18 +7034,24 @@ class MoviePlayer(QtWidgets.QWidget):
         self.updateStuff()
     
     # Method to show all the image
+    # Returns right away; frames are shown by the scheduler's timer, and
+    # late ones are dropped so the movie keeps to the frame rate
     def showAll(self, frameRate = None):
         if frameRate != None:
             self.framesPerSec = frameRate
-        startTime = 0;
-        endTime = 0;
-        timeToSleep = 1.0 / self.framesPerSec
-        for i in range(0,self.numberFrame,1):
-            startTime = time.time()
-            self.goToFrame(i)
-            endTime = time.time()
-            sleep(timeToSleep - (endTime - startTime))
+        self.scheduler.stop()
+        self.numberFrame = len(self.movieList)
+        durations = [self.movie.getFrameDuration(i, 1.0 / self.framesPerSec)
+            for i in range(self.numberFrame)]
+        self.scheduler.play(durations)
+    
+    # Method called when the movie has finished playing
+    def donePlaying(self):
         self.updateStuff()
+        if self.numberFrame != 0:
+            self.numLabel.setText("Frame Number %d (%.1f frames per second, "
+                "%d dropped)" % (self.curentFrameNumber,
+                self.scheduler.achievedFps(), self.scheduler.dropped))
                 
      # Method to set the frames per second to show the movie
      # param: rate the number of frames to show per second
@@ -3602,20 +7062,20 @@ class MoviePlayer(QtWidgets.QWidget):
     # Method to delete all the frames before the current one
     def delAllBefore(self):
         currentIndex = self.curentFrameNumber
-        for i in range(0,currentIndex+1):
-            # os.remove(self.movieList[0])
-            del self.movieList[0]
-        self.updateBuffer()
+        # os.remove(self.movieList[0])
+        self.movie.deleteFrames(0, currentIndex+1)
+        self.curentFrameNumber = 0
+        self.forgetRemoved()
         self.updateStuff()
         # self.update()
 
     # Method to delete all the frames after the current one
     def delAllAfter(self):
         currentIndex = self.curentFrameNumber
-        for i in range(currentIndex,self.numberFrame):
-            # os.remove(self.movieList[currentIndex])
-            del self.movieList[currentIndex]
-        self.updateBuffer()
+        # os.remove(self.movieList[currentIndex])
+        self.movie.deleteFrames(currentIndex, len(self.movieList))
+        self.curentFrameNumber = currentIndex - 1
+        self.forgetRemoved()
         self.updateStuff()
         # self.update()
         
@@ -3626,22 +7086,19 @@ class MoviePlayer(QtWidgets.QWidget):
         # writer.writeQuicktime();
         pass #TODO
 
-    # Method to write out the movie frames as a Quicktime movie
+    # Method to write out the movie frames as an AVI movie
     def writeAVI(self):
-        # MovieWriter writer = new MovieWriter(animationPanel.getFramesPerSec(),
-        #                                      dir);
-        # writer.writeAVI();
-        pass #TODO
+        path = pickASaveFile()
+        if path:
+            if not path.lower().endswith(".avi"):
+                path += ".avi"
+            self.movie.writeAVI(path, self.framesPerSec)
     
     # Method to add a picture to the movie
     # param: picture the picture to add
     def addPicture(self, picture):
         self.movie.addFrame(picture)
-        self.buf.open(QtCore.QIODevice.Append)
-        image = QtGui.QImage(picture)
-        image.save(self.buf, 'JPG')
-        self.buf.close()
-        self.update()
+        self.updateStuff()
     
     # Method to create # of Frame frame
     def createFrameLabel(self):
@@ -3661,8 +7118,6 @@ class MoviePlayer(QtWidgets.QWidget):
         layoutMovie = QtWidgets.QHBoxLayout()
         self.movieFrame.setLayout(layoutMovie)
         self.movieLabel = QtWidgets.QLabel("No movie loaded")
-        self.movieLabel.setMovie(self.movie)
-        self.updateBuffer()
         self.updateStuff()
         #self.playMovie()      
         # self.fitToWindow()